@@ -256,6 +256,9 @@ setup(name = 'Photini',
       cmdclass = cmdclass,
       command_options = command_options,
       entry_points = {
+          'console_scripts' : [
+              'photini-import = photini.batchimport:main',
+              ],
           'gui_scripts' : [
               'photini = photini.editor:main',
               ],
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##  Photini - a simple photo metadata editor.
+##  http://github.com/jim-easterbrook/Photini
+##  Copyright (C) 2012-17  Jim Easterbrook  jim@jim-easterbrook.me.uk
+##
+##  This program is free software: you can redistribute it and/or
+##  modify it under the terms of the GNU General Public License as
+##  published by the Free Software Foundation, either version 3 of the
+##  License, or (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+##  General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License
+##  along with this program.  If not, see
+##  <http://www.gnu.org/licenses/>.
+
+# Command line importer. This deliberately doesn't import photini.pyqt
+# (or anything else that uses Qt) so it can run on a headless server
+# and starts quickly.
+
+from datetime import datetime
+import json
+import logging
+from optparse import OptionParser
+import os
+import sys
+import threading
+
+from six.moves import queue
+
+from photini.configstore import BaseConfigStore
+from photini.importsource import (CameraSource, ExistingFiles, FolderSource,
+                                  get_camera_list, gp, PathFormat)
+from photini import __version__, build
+
+logger = logging.getLogger(__name__)
+
+# same as photini.pyqt.image_types() and video_types(), without the
+# extra formats found by asking Qt
+file_types = [
+    'jpeg', 'jpg', 'exv', 'cr2', 'crw', 'mrw', 'tiff', 'tif', 'dng',
+    'nef', 'pef', 'arw', 'rw2', 'sr2', 'srw', 'orf', 'png', 'pgf',
+    'raf', 'eps', 'gif', 'psd', 'tga', 'bmp', 'jp2', 'pnm',
+    'avi', 'mp4', 'mpeg', 'mpg', 'mov', 'qt', 'wmv',
+    ]
+
+# exit codes
+EXIT_OK = 0
+EXIT_COPY_FAILED = 1
+EXIT_USAGE = 2
+EXIT_SOURCE_FAILED = 3
+
+
+class Reporter(object):
+    # write progress as plain text or as one JSON object per line
+    def __init__(self, use_json):
+        self.use_json = use_json
+        self.lock = threading.Lock()
+
+    def report(self, event, text, **kw):
+        with self.lock:
+            if self.use_json:
+                kw['event'] = event
+                sys.stdout.write(json.dumps(kw, sort_keys=True) + '\n')
+            else:
+                sys.stdout.write(text + '\n')
+            sys.stdout.flush()
+
+
+def get_source(options, args):
+    # returns source object and config section name
+    if options.camera:
+        for model, port_name in get_camera_list():
+            if model == options.camera:
+                return (CameraSource(model, port_name),
+                        'importer ' + model)
+        raise RuntimeError('Camera "{}" not found'.format(options.camera))
+    root = os.path.abspath(args[0])
+    return (FolderSource(root, file_types=file_types),
+            'importer folder ' + root)
+
+
+def copy_worker(session, work, reporter, results):
+    while True:
+        item = work.get()
+        if item is None:
+            return
+        dest_path = item['dest_path']
+        try:
+            dest_dir = os.path.dirname(dest_path)
+            if not os.path.isdir(dest_dir):
+                try:
+                    os.makedirs(dest_dir)
+                except OSError:
+                    # another worker may have just created it
+                    if not os.path.isdir(dest_dir):
+                        raise
+            session.copy_file(item, dest_path)
+        except Exception as ex:
+            results.append((item, str(ex)))
+            reporter.report('error', '{} failed: {}'.format(item['name'], ex),
+                            name=item['name'], dest=dest_path, error=str(ex))
+            continue
+        results.append((item, None))
+        reporter.report(
+            'copied', '{} -> {}'.format(item['name'], dest_path),
+            name=item['name'], dest=dest_path, done=len(results))
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    parser = OptionParser(
+        usage='Usage: %prog [options] [source_folder]',
+        version='Photini ' + __version__ + ', build ' + build,
+        description='Import photos without starting the Photini GUI. The'
+        ' target format uses the same rules as the "Import photos" tab.')
+    parser.add_option(
+        '-c', '--camera', metavar='MODEL',
+        help='import from camera MODEL instead of a folder')
+    parser.add_option(
+        '-l', '--list-cameras', action='store_true',
+        help='list connected cameras and exit')
+    parser.add_option(
+        '-f', '--format', metavar='FORMAT',
+        help='target format (default: format last used with this source)')
+    parser.add_option(
+        '-n', '--new', action='store_true',
+        help='only import files newer than the last import from this source')
+    parser.add_option(
+        '-d', '--dry-run', action='store_true',
+        help='show what would be copied, without copying anything')
+    parser.add_option(
+        '-j', '--jobs', type='int', default=4,
+        help='number of files to copy in parallel (default: %default)')
+    parser.add_option(
+        '--json', action='store_true',
+        help='write progress as one JSON object per line')
+    parser.add_option(
+        '-v', '--verbose', action='count', default=0,
+        help='increase number of logging messages')
+    options, args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=max(logging.WARNING - (options.verbose * 10), 1))
+    reporter = Reporter(options.json)
+    if options.list_cameras:
+        for model, port_name in get_camera_list():
+            reporter.report('camera', '{} ({})'.format(model, port_name),
+                            model=model, port=port_name)
+        return EXIT_OK
+    if options.camera:
+        if not gp:
+            parser.error('python-gphoto2 is not installed')
+        if args:
+            parser.error('give a folder or a camera, not both')
+    elif len(args) != 1:
+        parser.error('give one source folder')
+    if options.jobs < 1:
+        parser.error('jobs must be at least 1')
+    config_store = BaseConfigStore('editor')
+    try:
+        session, config_section = get_source(options, args)
+    except Exception as ex:
+        reporter.report('error', str(ex), error=str(ex))
+        return EXIT_SOURCE_FAILED
+    try:
+        # get target format
+        format_string = options.format or config_store.get(
+            config_section, 'path_format')
+        if not format_string:
+            format_string = os.path.join(
+                os.path.expanduser('~/Pictures'), '%Y', '%Y_%m_%d', '(name)')
+        format_string = os.path.abspath(format_string)
+        path_format = PathFormat(format_string)
+        # get earliest timestamp to copy
+        since = datetime.min
+        if options.new:
+            last_transfer = config_store.get(config_section, 'last_transfer')
+            if last_transfer and len(last_transfer) > 19:
+                since = datetime.strptime(
+                    last_transfer, '%Y-%m-%d %H:%M:%S.%f')
+            elif last_transfer:
+                since = datetime.strptime(last_transfer, '%Y-%m-%d %H:%M:%S')
+        # make plan
+        copy_list = []
+        existing_files = ExistingFiles()
+        planned = set()
+        skipped = 0
+        try:
+            file_list = [session.get_file_info(x)
+                         for x in session.list_files()]
+        except Exception as ex:
+            reporter.report('error', 'cannot read source: {}'.format(ex),
+                            error=str(ex))
+            return EXIT_SOURCE_FAILED
+        for info in file_list:
+            if info['timestamp'] <= since:
+                continue
+            dest_path = path_format.transform(info)
+            if dest_path in planned or existing_files.exists(dest_path):
+                skipped += 1
+                continue
+            info['dest_path'] = dest_path
+            planned.add(dest_path)
+            copy_list.append(info)
+        copy_list.sort(key=lambda x: x['timestamp'])
+        total = len(copy_list)
+        reporter.report('plan', '{:d} files to copy, {:d} already copied'.format(
+            total, skipped), total=total, skipped=skipped, format=format_string)
+        if options.dry_run:
+            for item in copy_list:
+                reporter.report(
+                    'planned', '{} -> {}'.format(item['name'], item['dest_path']),
+                    name=item['name'], dest=item['dest_path'])
+            return EXIT_OK
+        # copy files, in parallel unless it's a camera
+        jobs = options.jobs
+        if isinstance(session, CameraSource):
+            jobs = 1
+        work = queue.Queue()
+        for item in copy_list:
+            work.put(item)
+        results = []
+        workers = []
+        for n in range(min(jobs, max(total, 1))):
+            work.put(None)
+            worker = threading.Thread(
+                target=copy_worker, args=(session, work, reporter, results))
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+    finally:
+        session.close()
+    # record last transfer, as the GUI importer does
+    copied = [item for item, error in results if not error]
+    failed = len(results) - len(copied)
+    if copied:
+        last_transfer = max([item['timestamp'] for item in copied])
+        config_store.set(
+            config_section, 'last_transfer', last_transfer.isoformat(' '))
+    if options.format:
+        config_store.set(config_section, 'path_format', format_string)
+    config_store.save()
+    reporter.report(
+        'finished', '{:d} copied, {:d} failed'.format(len(copied), failed),
+        copied=len(copied), failed=failed)
+    if failed:
+        return EXIT_COPY_FAILED
+    return EXIT_OK
+
+if __name__ == "__main__":
+    sys.exit(main())
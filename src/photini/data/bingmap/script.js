@@ -18,6 +18,7 @@
 
 var map;
 var markers = {};
+var clusters = {};
 var searchManager;
 
 function loadMap()
@@ -112,6 +113,7 @@ function addMarker(id, lat, lng, active)
     if (markers[id])
     {
         markers[id].setLocation(position);
+        enableMarker(id, active);
         return;
     }
     var marker = new Microsoft.Maps.Pushpin(position, {draggable: true});
@@ -121,7 +123,7 @@ function addMarker(id, lat, lng, active)
     Microsoft.Maps.Events.addHandler(marker, 'click', markerClick);
     Microsoft.Maps.Events.addHandler(marker, 'dragstart', markerClick);
     Microsoft.Maps.Events.addHandler(marker, 'drag', markerDrag);
-    Microsoft.Maps.Events.addHandler(marker, 'dragend', markerDrag);
+    Microsoft.Maps.Events.addHandler(marker, 'dragend', markerDragEnd);
     enableMarker(id, active);
 }
 
@@ -138,6 +140,13 @@ function markerDrag(event)
     python.marker_drag(loc.latitude, loc.longitude, marker._id);
 }
 
+function markerDragEnd(event)
+{
+    var marker = event.target;
+    var loc = marker.getLocation();
+    python.marker_drag_end(loc.latitude, loc.longitude, marker._id);
+}
+
 function markerDrop(x, y)
 {
     var position = map.tryPixelToLocation(
@@ -158,6 +167,72 @@ function removeMarkers()
 {
     map.entities.clear();
     markers = {};
+    clusters = {};
+}
+
+function addCluster(id, lat, lng, count, active)
+{
+    var position = new Microsoft.Maps.Location(lat, lng);
+    var cluster = clusters[id];
+    if (cluster)
+        cluster.setLocation(position);
+    else
+    {
+        cluster = new Microsoft.Maps.Pushpin(position);
+        map.entities.push(cluster);
+        clusters[id] = cluster;
+        cluster._id = id;
+        Microsoft.Maps.Events.addHandler(cluster, 'click', clusterClick);
+    }
+    cluster.setOptions({
+        text: String(count),
+        color: active ? 'Orchid' : 'DimGrey',
+        zIndex: active ? 1 : 0
+        });
+}
+
+function clusterClick(event)
+{
+    python.cluster_click(event.target._id);
+}
+
+function delCluster(id)
+{
+    if (clusters[id])
+    {
+        map.entities.remove(clusters[id]);
+        delete clusters[id];
+    }
+}
+
+function updateMarkers(ops)
+{
+    // apply a batch of marker operations sent from Python
+    for (var i = 0; i < ops.length; i++)
+    {
+        var op = ops[i];
+        switch (op[0])
+        {
+            case 'add':
+                addMarker(op[1], op[2], op[3], op[4]);
+                break;
+            case 'enable':
+                enableMarker(op[1], op[2]);
+                break;
+            case 'del':
+                delMarker(op[1]);
+                break;
+            case 'cluster':
+                addCluster(op[1], op[2], op[3], op[4], op[5]);
+                break;
+            case 'uncluster':
+                delCluster(op[1]);
+                break;
+            case 'clear':
+                removeMarkers();
+                break;
+        }
+    }
 }
 
 function search(search_string)
@@ -19,6 +19,7 @@
 var geocoder;
 var map;
 var markers = {};
+var clusters = {};
 
 function loadMap()
 {
@@ -110,6 +111,7 @@ function addMarker(id, lat, lng, active)
     if (markers[id])
     {
         markers[id].setPosition(position);
+        enableMarker(id, active);
         return;
     }
     var marker = new google.maps.Marker({
@@ -131,7 +133,7 @@ function addMarker(id, lat, lng, active)
         });
     google.maps.event.addListener(marker, 'dragend', function(event) {
         var loc = event.latLng;
-        python.marker_drag(loc.lat(), loc.lng(), this._id);
+        python.marker_drag_end(loc.lat(), loc.lng(), this._id);
         });
     enableMarker(id, active)
 }
@@ -171,6 +173,80 @@ function removeMarkers()
         markers[id].setMap(null);
     }
     markers = {};
+    for (var id in clusters)
+    {
+        google.maps.event.clearInstanceListeners(clusters[id]);
+        clusters[id].setMap(null);
+    }
+    clusters = {};
+}
+
+function addCluster(id, lat, lng, count, active)
+{
+    var position = new google.maps.LatLng(lat, lng);
+    var cluster = clusters[id];
+    if (!cluster)
+    {
+        cluster = new google.maps.Marker({position: position, map: map});
+        clusters[id] = cluster;
+        cluster._id = id;
+        google.maps.event.addListener(cluster, 'click', function(event) {
+            python.cluster_click(this._id)
+            });
+    }
+    cluster.setOptions({
+        position: position,
+        icon: {
+            path: google.maps.SymbolPath.CIRCLE,
+            scale: 15,
+            fillColor: active ? '#ea4335' : '#7b7b7b',
+            fillOpacity: 1,
+            strokeColor: 'white',
+            strokeWeight: 2
+            },
+        label: {text: String(count), color: 'white', fontWeight: 'bold'},
+        zIndex: active ? 1 : 0
+        });
+}
+
+function delCluster(id)
+{
+    if (clusters[id])
+    {
+        google.maps.event.clearInstanceListeners(clusters[id]);
+        clusters[id].setMap(null);
+        delete clusters[id];
+    }
+}
+
+function updateMarkers(ops)
+{
+    // apply a batch of marker operations sent from Python
+    for (var i = 0; i < ops.length; i++)
+    {
+        var op = ops[i];
+        switch (op[0])
+        {
+            case 'add':
+                addMarker(op[1], op[2], op[3], op[4]);
+                break;
+            case 'enable':
+                enableMarker(op[1], op[2]);
+                break;
+            case 'del':
+                delMarker(op[1]);
+                break;
+            case 'cluster':
+                addCluster(op[1], op[2], op[3], op[4], op[5]);
+                break;
+            case 'uncluster':
+                delCluster(op[1]);
+                break;
+            case 'clear':
+                removeMarkers();
+                break;
+        }
+    }
 }
 
 function search(search_string)
@@ -18,8 +18,79 @@
 
 var map;
 var markers = {};
+var clusters = {};
 var icon_on;
 var icon_off;
+var pendingTiles = {};
+
+// tiles are supplied by Python, which keeps a local cache
+var CachedTileLayer = L.GridLayer.extend({
+    createTile: function(coords, done) {
+        var tile = document.createElement('img');
+        tile.alt = '';
+        var key = tileKey(coords);
+        if (!pendingTiles[key])
+            pendingTiles[key] = [];
+        pendingTiles[key].push({tile: tile, done: done});
+        python.request_tile(key);
+        return tile;
+        }
+    });
+
+function tileKey(coords)
+{
+    var n = Math.pow(2, coords.z);
+    var x = ((coords.x % n) + n) % n;
+    return coords.z + '/' + x + '/' + coords.y;
+}
+
+function tileUnload(event)
+{
+    var key = tileKey(event.coords);
+    var pending = pendingTiles[key];
+    if (!pending)
+        return;
+    for (var i = 0; i < pending.length; i++)
+    {
+        if (pending[i].tile === event.tile)
+        {
+            pending.splice(i, 1);
+            break;
+        }
+    }
+    if (pending.length == 0)
+    {
+        delete pendingTiles[key];
+        python.release_tile(key);
+    }
+}
+
+function tilesReady(results)
+{
+    for (var i = 0; i < results.length; i++)
+    {
+        var key = results[i][0];
+        var url = results[i][1];
+        var pending = pendingTiles[key];
+        if (!pending)
+            continue;
+        delete pendingTiles[key];
+        for (var j = 0; j < pending.length; j++)
+            loadTile(pending[j].tile, pending[j].done, url);
+    }
+}
+
+function loadTile(tile, done, url)
+{
+    if (!url)
+    {
+        done(new Error('tile not available'), tile);
+        return;
+    }
+    tile.onload = function() {done(null, tile);};
+    tile.onerror = function() {done(new Error('bad tile'), tile);};
+    tile.src = url;
+}
 
 function loadMap()
 {
@@ -28,9 +99,9 @@ function loadMap()
         zoom: initData.zoom,
         attributionControl: false,
         });
-    L.tileLayer(
-        'https://cartodb-basemaps-{s}.global.ssl.fastly.net/light_all/{z}/{x}/{y}.png',
-        {maxZoom: 18}).addTo(map);
+    var tileLayer = new CachedTileLayer({maxZoom: 18});
+    tileLayer.on('tileunload', tileUnload);
+    tileLayer.addTo(map);
     L.control.scale().addTo(map);
     map.on('moveend zoomend', newBounds);
     icon_on = new L.Icon.Default();
@@ -94,6 +165,7 @@ function addMarker(id, lat, lng, active)
     if (markers[id])
     {
         markers[id].setLatLng([lat, lng]);
+        enableMarker(id, active);
         return;
     }
     var marker = L.marker([lat, lng], {draggable: true});
@@ -126,7 +198,7 @@ function markerDrag(event)
 function markerDragEnd(event)
 {
     var loc = this.getLatLng();
-    python.marker_drag(loc.lat, loc.lng, this._id);
+    python.marker_drag_end(loc.lat, loc.lng, this._id);
     python.marker_click(this._id);
 }
 
@@ -150,4 +222,80 @@ function removeMarkers()
     for (var id in markers)
         map.removeLayer(markers[id]);
     markers = {};
+    for (var id in clusters)
+        map.removeLayer(clusters[id]);
+    clusters = {};
+}
+
+function clusterIcon(count, active)
+{
+    var colour = active ? '#2a81cb' : '#7b7b7b';
+    return L.divIcon({
+        html: '<div style="width: 30px; height: 30px; line-height: 30px; ' +
+              'border-radius: 15px; text-align: center; color: white; ' +
+              'font-weight: bold; border: 2px solid white; background: ' +
+              colour + '">' + count + '</div>',
+        className: '',
+        iconSize: [34, 34]});
+}
+
+function addCluster(id, lat, lng, count, active)
+{
+    var cluster = clusters[id];
+    if (cluster)
+        cluster.setLatLng([lat, lng]);
+    else
+    {
+        cluster = L.marker([lat, lng]);
+        cluster.addTo(map);
+        clusters[id] = cluster;
+        cluster._id = id;
+        cluster.on('click', clusterClick);
+    }
+    cluster.setIcon(clusterIcon(count, active));
+    cluster.setZIndexOffset(active ? 1000 : 0);
+}
+
+function clusterClick(event)
+{
+    python.cluster_click(this._id);
+}
+
+function delCluster(id)
+{
+    if (clusters[id])
+    {
+        map.removeLayer(clusters[id]);
+        delete clusters[id];
+    }
+}
+
+function updateMarkers(ops)
+{
+    // apply a batch of marker operations sent from Python
+    for (var i = 0; i < ops.length; i++)
+    {
+        var op = ops[i];
+        switch (op[0])
+        {
+            case 'add':
+                addMarker(op[1], op[2], op[3], op[4]);
+                break;
+            case 'enable':
+                enableMarker(op[1], op[2]);
+                break;
+            case 'del':
+                delMarker(op[1]);
+                break;
+            case 'cluster':
+                addCluster(op[1], op[2], op[3], op[4], op[5]);
+                break;
+            case 'uncluster':
+                delCluster(op[1]);
+                break;
+            case 'clear':
+                removeMarkers();
+                break;
+        }
+    }
 }
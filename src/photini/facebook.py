@@ -20,6 +20,7 @@ from __future__ import unicode_literals
 
 import six
 from collections import defaultdict
+import io
 import logging
 import math
 import os
@@ -32,7 +33,6 @@ try:
 except ImportError:
     PIL = None
 import pkg_resources
-import requests
 from requests_oauthlib import OAuth2Session
 from requests_toolbelt import MultipartEncoder
 
@@ -40,7 +40,8 @@ from photini.configstore import key_store
 from photini.pyqt import (
     Busy, MultiLineEdit, Qt, QtCore, QtGui, QtWebEngineWidgets,
     QtWebKitWidgets, QtWidgets, SingleLineEdit)
-from photini.uploader import PhotiniUploader
+from photini.uploader import (
+    http_session, PhotiniUploader, retry_upload, use_shared_pool)
 
 logger = logging.getLogger(__name__)
 cities_cache = []
@@ -66,7 +67,7 @@ class FacebookSession(object):
             return False
         if not self.session:
             token = {'access_token': access_token}
-            self.session = OAuth2Session(token=token)
+            self.session = use_shared_pool(OAuth2Session(token=token))
         try:
             permissions = self.get('https://graph.facebook.com/me/permissions')
         except Exception:
@@ -92,10 +93,10 @@ class FacebookSession(object):
         logger.info('using %s', keyring.get_keyring().__module__)
         app_id = key_store.get('facebook', 'app_id')
         client = oauthlib.oauth2.MobileApplicationClient(app_id)
-        self.session = OAuth2Session(
+        self.session = use_shared_pool(OAuth2Session(
             client=client, scope=self.scope[level],
             redirect_uri='https://www.facebook.com/connect/login_success.html',
-            )
+            ))
         result = self.session.authorization_url(
             'https://www.facebook.com/dialog/oauth',
             display='popup', auth_type='rerequest')[0]
@@ -223,21 +224,33 @@ class FacebookSession(object):
             })
         return result
 
+    def get_caption(self, image):
+        title = image.metadata.title
+        description = image.metadata.description
+        if title and description:
+            return title.value + '\n\n' + description.value
+        if title:
+            return title.value
+        if description:
+            return description.value
+        return ''
+
+    def do_metadata_update(self, photo_id, image, params):
+        # Facebook only allows the caption of an existing photo to be
+        # changed
+        try:
+            self.post('https://graph.facebook.com/v2.6/' + photo_id,
+                      data={'name': self.get_caption(image)})
+        except Exception as ex:
+            return str(ex)
+        return ''
+
     def do_upload(self, fileobj, image_type, image, params):
         fields = {
             'photo'   : ('source', fileobj),
             'no_story': str(params['no_story']),
             }
-        title = image.metadata.title
-        description = image.metadata.description
-        if title and description:
-            caption = title.value + '\n\n' + description.value
-        elif title:
-            caption = title.value
-        elif description:
-            caption = description.value
-        else:
-            caption = ''
+        caption = self.get_caption(image)
         if caption:
             fields['caption'] = caption
         date_taken = image.metadata.date_taken
@@ -256,14 +269,19 @@ class FacebookSession(object):
             nearest = nearest[0]
             if nearest:
                 fields['place'] = nearest['id']
-        data = MultipartEncoder(fields=fields)
-        headers = {'Content-Type' : data.content_type}
         url = 'https://graph.facebook.com/v2.6/' + params['album_id'] + '/photos'
+
+        def post():
+            # encoder is used up by each attempt
+            data = MultipartEncoder(fields=fields)
+            headers = {'Content-Type' : data.content_type}
+            return self.post(url, data=data, headers=headers)
+
         try:
-            self.post(url, data=data, headers=headers)
+            rsp = retry_upload(fileobj, post)
         except Exception as ex:
-            return str(ex)
-        return ''
+            return str(ex), None
+        return '', rsp['id']
 
     def get(self, *arg, **kw):
         rsp = self.session.get(*arg, **kw)
@@ -406,7 +424,7 @@ class FacebookUploadConfig(QtWidgets.QWidget):
             self.widgets['album_location'].clear()
         pixmap = QtGui.QPixmap()
         if picture:
-            rsp = requests.get(picture)
+            rsp = http_session.get(picture)
             if rsp.status_code == 200:
                 pixmap.loadFromData(rsp.content)
             else:
@@ -416,6 +434,8 @@ class FacebookUploadConfig(QtWidgets.QWidget):
 
 class FacebookUploader(PhotiniUploader):
     session_factory = FacebookSession
+    config_section = 'facebook'
+    upload_worker_limits = (2, 3)
 
     def __init__(self, *arg, **kw):
         self.upload_config = FacebookUploadConfig()
@@ -488,12 +508,11 @@ class FacebookUploader(PhotiniUploader):
                 w = int((float(new_size * w) / float(h)) + 0.5)
                 h = new_size
             im = im.resize((w, h), PIL.ANTIALIAS)
-        # save as temporary jpeg file
-        path = self.get_temp_filename(image)
-        im.save(path, format='jpeg', quality=95)
+        # save as jpeg data in memory
+        buf = io.BytesIO()
+        im.save(buf, format='jpeg', quality=95)
         # copy metadata although Facebook wipes most of it at present
-        self.copy_metadata(image, path)
-        return path
+        return self.add_metadata(image, buf.getvalue())
 
     def get_conversion_function(self, image):
         if (PIL and self.upload_config.widgets['optimise'].isChecked() and
@@ -21,9 +21,9 @@ from __future__ import unicode_literals
 
 import logging
 import os
-import requests
 import six
 from six.moves.html_parser import HTMLParser
+import threading
 import time
 
 import flickrapi
@@ -32,12 +32,17 @@ import keyring
 from photini.configstore import key_store
 from photini.pyqt import (
     Busy, MultiLineEdit, Qt, QtCore, QtGui, QtWidgets, SingleLineEdit)
-from photini.uploader import PhotiniUploader
+from photini.uploader import (
+    http_session, PhotiniUploader, retry_upload, use_shared_pool)
 
 logger = logging.getLogger(__name__)
 
 flickr_version = 'flickrapi {}'.format(flickrapi.__version__)
 
+# parallel uploads share the list of albums, so only one at a time may
+# add to or create an album
+photoset_lock = threading.Lock()
+
 class FlickrSession(object):
     perms = {
         'read' : 'write',
@@ -64,8 +69,15 @@ class FlickrSession(object):
                 token, token_secret, self.perms[level])
             self.api = flickrapi.FlickrAPI(
                 api_key, api_secret, token=token, store_token=False)
+            self.use_shared_pool()
         return self.api.token_valid(perms=self.perms[level])
 
+    def use_shared_pool(self):
+        # flickrapi keeps its requests session in its OAuth interface
+        oauth = getattr(self.api, 'flickr_oauth', None)
+        if getattr(oauth, 'session', None):
+            use_shared_pool(oauth.session)
+
     def get_auth_url(self, level):
         logger.info('using %s', keyring.get_keyring().__module__)
         api_key    = key_store.get('flickr', 'api_key')
@@ -73,6 +85,7 @@ class FlickrSession(object):
         token = flickrapi.auth.FlickrAccessToken('', '', self.perms[level])
         self.api = flickrapi.FlickrAPI(
             api_key, api_secret, token=token, store_token=False)
+        self.use_shared_pool()
         self.api.get_request_token(oauth_callback='oob')
         return self.api.auth_url(perms=self.perms[level])
 
@@ -105,33 +118,65 @@ class FlickrSession(object):
                 person['iconfarm'], person['iconserver'], person['nsid'])
         else:
             icon_url = 'https://www.flickr.com/images/buddyicon.gif'
-        rsp = requests.get(icon_url)
+        rsp = http_session.get(icon_url)
         if rsp.status_code == 200:
             result = user['fullname'], rsp.content
         else:
             logger.error('HTTP error %d (%s)', rsp.status_code, icon_url)
         return result
 
-    def do_upload(self, fileobj, image_type, image, params):
-        # collect metadata
-        kwargs = dict(params[0])
+    def get_metadata(self, image):
+        result = {}
         title = image.metadata.title
         if title:
-            kwargs['title'] = title.value
+            result['title'] = title.value
         description = image.metadata.description
         if description:
-            kwargs['description'] = description.value
+            result['description'] = description.value
         keywords = image.metadata.keywords
         if keywords:
-            kwargs['tags'] = ' '.join(['"' + x + '"' for x in keywords.value])
-        # upload photo
+            result['tags'] = ' '.join(['"' + x + '"' for x in keywords.value])
+        return result
+
+    def do_metadata_update(self, photo_id, image, params):
+        metadata = self.get_metadata(image)
         try:
-            rsp = self.api.upload(image.path, fileobj=fileobj, **kwargs)
+            self.api.photos_setMeta(
+                photo_id=photo_id, title=metadata.get('title', ''),
+                description=metadata.get('description', ''))
+            self.api.photos_setTags(
+                photo_id=photo_id, tags=metadata.get('tags', ''))
+            date_taken = image.metadata.date_taken
+            if date_taken:
+                granularity = 0
+                if date_taken.precision <= 2:
+                    granularity = 8 - (date_taken.precision * 2)
+                self.api.photos_setDates(
+                    photo_id=photo_id,
+                    date_taken=date_taken.datetime.strftime(
+                        '%Y-%m-%d %H:%M:%S'),
+                    date_taken_granularity=granularity)
+            latlong = image.metadata.latlong
+            if latlong:
+                self.api.photos_geo_setLocation(
+                    photo_id=photo_id, lat=latlong.lat, lon=latlong.lon)
         except Exception as ex:
             return str(ex)
+        return ''
+
+    def do_upload(self, fileobj, image_type, image, params):
+        # collect metadata
+        kwargs = dict(params[0])
+        kwargs.update(self.get_metadata(image))
+        # upload photo
+        try:
+            rsp = retry_upload(fileobj, self.api.upload, image.path,
+                               fileobj=fileobj, **kwargs)
+        except Exception as ex:
+            return str(ex), None
         status = rsp.attrib['stat']
         if status != 'ok':
-            return status
+            return status, None
         photo_id = rsp.find('photoid').text
         # set date granularity
         date_taken = image.metadata.date_taken
@@ -148,34 +193,35 @@ class FlickrSession(object):
                 except flickrapi.FlickrError as ex:
                     status = str(ex)
             else:
-                return status
+                return status, None
         # add to sets
-        for p_set in params[1]:
-            if p_set['id']:
-                # add to existing set
+        with photoset_lock:
+            for p_set in params[1]:
+                if p_set['id']:
+                    # add to existing set
+                    try:
+                        self.api.photosets_addPhoto(
+                            photo_id=photo_id, photoset_id=p_set['id'])
+                        continue
+                    except flickrapi.FlickrError as ex:
+                        logger.error('Add to photoset "%s" failed: %s',
+                                     p_set['title'], str(ex))
+                        p_set['id'] = None
+                # create new set
                 try:
-                    self.api.photosets_addPhoto(
-                        photo_id=photo_id, photoset_id=p_set['id'])
-                    continue
+                    rsp = self.api.photosets_create(
+                        title=p_set['title'], description=p_set['description'],
+                        primary_photo_id=photo_id)
                 except flickrapi.FlickrError as ex:
-                    logger.error('Add to photoset "%s" failed: %s',
+                    logger.error('Create photoset "%s" failed: %s',
                                  p_set['title'], str(ex))
-                    p_set['id'] = None
-            # create new set
-            try:
-                rsp = self.api.photosets_create(
-                    title=p_set['title'], description=p_set['description'],
-                    primary_photo_id=photo_id)
-            except flickrapi.FlickrError as ex:
-                logger.error('Create photoset "%s" failed: %s',
-                             p_set['title'], str(ex))
-                continue
-            if rsp.attrib['stat'] == 'ok':
-                p_set['id'] = rsp.find('photoset').attrib['id']
-            else:
-                logger.error('Create photoset "%s" failed: %s',
-                             p_set['title'], rsp.attrib['stat'])
-        return ''
+                    continue
+                if rsp.attrib['stat'] == 'ok':
+                    p_set['id'] = rsp.find('photoset').attrib['id']
+                else:
+                    logger.error('Create photoset "%s" failed: %s',
+                                 p_set['title'], rsp.attrib['stat'])
+        return '', photo_id
 
     # delegate all other attributes to api object
     def __getattr__(self, name):
@@ -292,6 +338,8 @@ class FlickrUploadConfig(QtWidgets.QWidget):
 
 class FlickrUploader(PhotiniUploader):
     session_factory = FlickrSession
+    config_section = 'flickr'
+    upload_worker_limits = (3, 4)
 
     def __init__(self, *arg, **kw):
         self.upload_config = FlickrUploadConfig()
@@ -332,6 +380,13 @@ class FlickrUploader(PhotiniUploader):
                 add_to_sets.append(item)
         return fixed_params, add_to_sets
 
+    def save_upload_params(self, params):
+        # drop album widgets
+        fixed_params, add_to_sets = params
+        return fixed_params, [
+            {'id': x['id'], 'title': x['title'],
+             'description': x.get('description')} for x in add_to_sets]
+
     def upload_finished(self):
         pass
 
@@ -23,149 +23,142 @@ from contextlib import contextmanager
 from datetime import datetime
 import logging
 import os
-import six
-import re
-import shutil
 import sys
 
-try:
-    import gphoto2 as gp
-except ImportError:
-    gp = None
+from photini.importsource import (CameraSource, ExistingFiles, FolderSource,
+                                  get_camera_list, gp, PathFormat)
+from photini.pyqt import (Busy, QItemSelection, QItemSelectionModel, Qt,
+                          QtCore, QtGui, QtWidgets, StartStopButton)
+
+logger = logging.getLogger(__name__)
+
+
+class FolderWatcher(QtCore.QObject):
+    """Detect new, fully written image files in a source folder.
+
+    Uses QFileSystemWatcher (inotify on Linux) so nothing runs while
+    the folder is idle. Directories that can't be watched are polled
+    instead. Files are reported once their size and modification time
+    have stopped changing between two scans.
+
+    """
+    new_files = QtCore.pyqtSignal(list)
+
+    def __init__(self, source, known_files, parent=None):
+        super(FolderWatcher, self).__init__(parent)
+        self.source = source
+        self.known_files = set(known_files)
+        self.pending = {}
+        self.changed_dirs = set()
+        self.dirs = set()
+        self.watcher = QtCore.QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.dir_changed)
+        # wait for a quiet period before scanning, to batch up changes
+        self.scan_timer = QtCore.QTimer(self)
+        self.scan_timer.setSingleShot(True)
+        self.scan_timer.setInterval(2000)
+        self.scan_timer.timeout.connect(self.scan)
+        # fallback for directories the watcher can't handle
+        self.poll_dirs = set()
+        self.poll_timer = QtCore.QTimer(self)
+        self.poll_timer.setInterval(10000)
+        self.poll_timer.timeout.connect(self.poll)
+        self.add_dirs(self.source.root)
 
-from photini.metadata import Metadata
-from photini.pyqt import (Busy, image_types, Qt, QtCore, QtGui, QtWidgets,
-                          StartStopButton, video_types)
+    def close(self):
+        self.scan_timer.stop()
+        self.poll_timer.stop()
+        if self.watcher.directories():
+            self.watcher.removePaths(self.watcher.directories())
+
+    def add_dirs(self, root):
+        new_dirs = []
+        for path, dirs, files in os.walk(root):
+            if path not in self.dirs:
+                new_dirs.append(path)
+        if not new_dirs:
+            return new_dirs
+        self.dirs.update(new_dirs)
+        self.watcher.addPaths(new_dirs)
+        watched = set(self.watcher.directories())
+        for path in new_dirs:
+            if path not in watched:
+                self.poll_dirs.add(path)
+        if self.poll_dirs and not self.poll_timer.isActive():
+            self.poll_timer.start()
+        return new_dirs
 
-class FolderSource(object):
-    def __init__(self, root):
-        self.root = root
-        self.image_types = ['.' + x for x in image_types() + video_types()]
-        if not os.path.isdir(self.root):
-            raise RuntimeError('Folder not readable')
+    @QtCore.pyqtSlot(str)
+    def dir_changed(self, path):
+        self.changed_dirs.add(path)
+        self.scan_timer.start()
 
-    def close(self):
-        pass
+    @QtCore.pyqtSlot()
+    def poll(self):
+        self.changed_dirs.update(self.poll_dirs)
+        self.scan()
 
-    def list_files(self):
-        result = []
-        for root, dirs, files in os.walk(self.root):
-            for name in files:
+    @QtCore.pyqtSlot()
+    def scan(self):
+        changed_dirs = self.changed_dirs
+        self.changed_dirs = set()
+        for root in changed_dirs:
+            if not os.path.isdir(root):
+                self.dirs.discard(root)
+                self.poll_dirs.discard(root)
+                continue
+            try:
+                names = os.listdir(root)
+            except OSError as ex:
+                # e.g. folder has been unmounted
+                logger.warning('%s: %s', root, str(ex))
+                continue
+            for name in names:
+                path = os.path.join(root, name)
+                if os.path.isdir(path):
+                    if path not in self.dirs:
+                        self.changed_dirs.update(self.add_dirs(path))
+                    continue
                 base, ext = os.path.splitext(name)
-                if ext.lower() in self.image_types:
-                    result.append(os.path.join(root, name))
-        return result
-
-    def get_file_info(self, path):
-        metadata = Metadata(path, None)
-        timestamp = metadata.date_taken
-        if not timestamp:
-            timestamp = metadata.date_digitised
-        if not timestamp:
-            timestamp = metadata.date_modified
-        if not timestamp:
-            # use file date as last resort
-            timestamp = datetime.fromtimestamp(os.path.getmtime(path))
-        else:
-            timestamp = timestamp.datetime
-        folder, name = os.path.split(path)
-        return {
-            'camera'    : six.text_type(metadata.camera_model),
-            'path'      : path,
-            'name'      : name,
-            'timestamp' : timestamp,
-            }
-
-    def copy_file(self, info, dest):
-        shutil.copy2(info['path'], dest)
-        return None
-
-
-class CameraSource(object):
-    def __init__(self, model, port_name):
-        self.model = model
-        self.port_name = port_name
-        self.context = gp.Context()
-        # initialise camera
-        self.camera = gp.Camera()
-        # search ports for camera port name
-        port_info_list = gp.PortInfoList()
-        port_info_list.load()
-        idx = port_info_list.lookup_path(self.port_name)
-        self.camera.set_port_info(port_info_list[idx])
-        self.camera.init(self.context)
-        # check camera is the right model
-        if self.camera.get_abilities().model != self.model:
-            raise RuntimeError('Camera model mismatch')
-
-    def close(self):
-        # free camera
-        self.camera.exit(self.context)
-
-    def list_files(self, path='/'):
-        result = []
-        # get files
-        for name, value in self.camera.folder_list_files(path, self.context):
-            result.append(os.path.join(path, name))
-        # get folders
-        folders = []
-        for name, value in self.camera.folder_list_folders(path, self.context):
-            folders.append(name)
-        # recurse over subfolders
-        for name in folders:
-            result.extend(self.list_files(os.path.join(path, name)))
-        return result
-
-    def get_file_info(self, path):
-        folder, name = os.path.split(path)
-        info = self.camera.file_get_info(str(folder), str(name), self.context)
-        timestamp = datetime.utcfromtimestamp(info.file.mtime)
-        return {
-            'camera'    : self.model,
-            'folder'    : folder,
-            'name'      : name,
-            'timestamp' : timestamp,
-            }
-
-    def copy_file(self, info, dest):
-        return self.camera.file_get(
-            info['folder'], info['name'], gp.GP_FILE_TYPE_NORMAL, self.context)
-
-
-def get_camera_list():
-    if not gp:
-        return []
-    context = gp.Context()
-    camera_list = []
-    for name, addr in context.camera_autodetect():
-        camera_list.append((name, addr))
-    camera_list.sort(key=lambda x: x[0])
-    return camera_list
+                if (ext.lower() in self.source.image_types and
+                        path not in self.known_files and
+                        path not in self.pending):
+                    self.pending[path] = None
+        # check pending files are no longer being written
+        ready = []
+        for path in list(self.pending):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+            stamp = stat.st_size, stat.st_mtime
+            if stamp == self.pending[path]:
+                del self.pending[path]
+                self.known_files.add(path)
+                ready.append(path)
+            else:
+                self.pending[path] = stamp
+        if self.pending or self.changed_dirs:
+            self.scan_timer.start()
+        if ready:
+            ready.sort()
+            self.new_files.emit(ready)
 
 
 class NameMangler(QtCore.QObject):
-    number_parser = re.compile('\D*(\d+)')
     new_example = QtCore.pyqtSignal(str)
 
     def __init__(self, parent=None):
         super(NameMangler, self).__init__(parent)
         self.example = None
         self.format_string = None
+        self.path_format = None
 
     @QtCore.pyqtSlot(str)
     def new_format(self, format_string):
         self.format_string = format_string
-        # extract bracket delimited words from string
-        self.parts = []
-        while format_string:
-            parts = format_string.split('(', 1)
-            if len(parts) > 1:
-                parts[1:] = parts[1].split(')', 1)
-            if len(parts) < 3:
-                self.parts.append((format_string, ''))
-                break
-            self.parts.append((parts[0], parts[1]))
-            format_string = parts[2]
+        self.path_format = PathFormat(format_string)
         self.refresh_example()
 
     def set_example(self, example):
@@ -177,26 +170,61 @@ class NameMangler(QtCore.QObject):
             self.new_example.emit(self.transform(self.example))
 
     def transform(self, file_data):
-        name = file_data['name']
-        subst = {'name': name}
-        match = self.number_parser.match(name)
-        if match:
-            subst['number'] = match.group(1)
-        else:
-            subst['number'] = ''
-        subst['root'], subst['ext'] = os.path.splitext(name)
-        subst['camera'] = file_data['camera'] or 'unknown_camera'
-        subst['camera'] = subst['camera'].replace(' ', '_')
-        result = ''
-        # process (...) parts first
-        for left, right in self.parts:
-            result += left
-            if right in subst:
-                result += subst[right]
-            else:
-                result += right
-        # then do timestamp
-        return file_data['timestamp'].strftime(result)
+        return self.path_format.transform(file_data)
+
+
+class FileListModel(QtCore.QAbstractListModel):
+    """List model of files available for import.
+
+    Destination paths (and whether they already exist) are only
+    computed when a row is first displayed or selected, so that long
+    file lists don't need to be transformed all at once.
+
+    """
+    def __init__(self, name_mangler, parent=None):
+        super(FileListModel, self).__init__(parent)
+        self.nm = name_mangler
+        self.file_list = []
+        self.file_data = {}
+        self.dest_exists = {}
+        self.existing_files = ExistingFiles()
+
+    def set_file_list(self, file_list, file_data):
+        self.beginResetModel()
+        self.file_list = file_list
+        self.file_data = file_data
+        self.dest_exists = {}
+        self.existing_files = ExistingFiles()
+        self.endResetModel()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.file_list)
+
+    def info(self, row):
+        name = self.file_list[row]
+        file_data = self.file_data[name]
+        if name not in self.dest_exists:
+            dest_path = self.nm.transform(file_data)
+            file_data['dest_path'] = dest_path
+            self.dest_exists[name] = self.existing_files.exists(dest_path)
+        return file_data
+
+    def is_selectable(self, row):
+        self.info(row)
+        return not self.dest_exists[self.file_list[row]]
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        file_data = self.info(index.row())
+        return file_data['name'] + ' -> ' + file_data['dest_path']
+
+    def flags(self, index):
+        if not index.isValid() or not self.is_selectable(index.row()):
+            return Qt.NoItemFlags
+        return Qt.ItemIsSelectable | Qt.ItemIsEnabled
 
 
 class PathFormatValidator(QtGui.QValidator):
@@ -223,6 +251,8 @@ class Importer(QtWidgets.QWidget):
         self.file_list = []
         self.session_factory = None
         self.import_in_progress = False
+        self.folder_watcher = None
+        self.watched_files = []
         # source selector
         box = QtWidgets.QHBoxLayout()
         box.setContentsMargins(0, 0, 0, 0)
@@ -246,10 +276,14 @@ class Importer(QtWidgets.QWidget):
         form.addRow('=>', self.path_example)
         self.layout().addLayout(form, 0, 0)
         # file list
-        self.file_list_widget = QtWidgets.QListWidget()
+        self.file_list_model = FileListModel(self.nm, parent=self)
+        self.file_list_widget = QtWidgets.QListView()
+        self.file_list_widget.setUniformItemSizes(True)
+        self.file_list_widget.setModel(self.file_list_model)
         self.file_list_widget.setSelectionMode(
             QtWidgets.QAbstractItemView.ExtendedSelection)
-        self.file_list_widget.itemSelectionChanged.connect(self.selection_changed)
+        self.file_list_widget.selectionModel().selectionChanged.connect(
+            self.selection_changed)
         self.layout().addWidget(self.file_list_widget, 1, 0)
         # selection buttons
         buttons = QtWidgets.QVBoxLayout()
@@ -267,6 +301,11 @@ class Importer(QtWidgets.QWidget):
                                            self.tr('Stop\nimport'))
         self.copy_button.click_start.connect(self.copy_selected)
         buttons.addWidget(self.copy_button)
+        self.watch_button = QtWidgets.QPushButton(self.tr('Auto\nimport'))
+        self.watch_button.setCheckable(True)
+        self.watch_button.setEnabled(False)
+        self.watch_button.toggled.connect(self.watch_source)
+        buttons.addWidget(self.watch_button)
         self.layout().addLayout(buttons, 0, 1, 2, 1)
         # final initialisation
         self.image_list.sort_order_changed.connect(self.sort_file_list)
@@ -283,6 +322,8 @@ class Importer(QtWidgets.QWidget):
 
     @QtCore.pyqtSlot(int)
     def new_source(self, idx):
+        self.watch_button.setChecked(False)
+        self.watch_button.setEnabled(False)
         self.session_factory = None
         item_data = self.source_selector.itemData(idx)
         if callable(item_data):
@@ -296,10 +337,56 @@ class Importer(QtWidgets.QWidget):
         path_format = self.config_store.get(
             self.config_section, 'path_format', path_format)
         self.path_format.setText(path_format)
-        self.file_list_widget.clear()
+        self.file_list_model.set_file_list([], {})
+        self.watch_button.setEnabled(self.session_factory == FolderSource)
         # allow 100ms for display to update before getting file list
         QtCore.QTimer.singleShot(100, self.list_files)
 
+    @QtCore.pyqtSlot(bool)
+    def watch_source(self, checked):
+        if self.folder_watcher:
+            self.folder_watcher.close()
+            self.folder_watcher.deleteLater()
+            self.folder_watcher = None
+        self.watched_files = []
+        if not (checked and self.session_factory == FolderSource):
+            return
+        known_files = [x['path'] for x in self.file_data.values()]
+        with self.session() as session:
+            self.folder_watcher = FolderWatcher(
+                session, known_files, parent=self)
+        self.folder_watcher.new_files.connect(self.new_watched_files)
+
+    @QtCore.pyqtSlot(list)
+    def new_watched_files(self, paths):
+        self.watched_files += paths
+        self.auto_import()
+
+    @QtCore.pyqtSlot()
+    def auto_import(self):
+        if self.import_in_progress or not self.watched_files:
+            # try again when current import finishes
+            return
+        paths = self.watched_files
+        self.watched_files = []
+        names = set()
+        with self.session() as session:
+            for path in paths:
+                info = session.get_file_info(path)
+                self.file_data[info['name']] = info
+                names.add(info['name'])
+        self._new_file_list(self.file_data)
+        copy_list = []
+        for row in range(self.file_list_model.rowCount()):
+            if (self.file_list[row] in names and
+                    self.file_list_model.is_selectable(row)):
+                copy_list.append(self.file_list_model.info(row))
+        if copy_list:
+            self.copy_button.setChecked(True)
+            # keep files that weren't copied, to retry with the next batch
+            self.watched_files = [x['path'] for x in self.copy_files(
+                copy_list)] + self.watched_files
+
     def add_folder(self):
         folders = eval(self.config_store.get('importer', 'folders', '[]'))
         if folders:
@@ -435,29 +522,20 @@ class Importer(QtWidgets.QWidget):
         self.nm.set_example(example)
 
     def show_file_list(self):
-        self.file_list_widget.clear()
-        first_active = None
-        item = None
-        for name in self.file_list:
-            file_data = self.file_data[name]
-            dest_path = self.nm.transform(file_data)
-            file_data['dest_path'] = dest_path
-            item = QtWidgets.QListWidgetItem(name + ' -> ' + dest_path)
-            if os.path.exists(dest_path):
-                item.setFlags(Qt.NoItemFlags)
-            else:
-                if not first_active:
-                    first_active = item
-                item.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled)
-            self.file_list_widget.addItem(item)
-        if not first_active:
-            first_active = item
-        self.file_list_widget.scrollToItem(
-            first_active, QtWidgets.QAbstractItemView.PositionAtTop)
+        self.file_list_model.set_file_list(self.file_list, self.file_data)
+        count = self.file_list_model.rowCount()
+        if not count:
+            return
+        for row in range(count):
+            if self.file_list_model.is_selectable(row):
+                break
+        self.file_list_widget.scrollTo(
+            self.file_list_model.index(row),
+            QtWidgets.QAbstractItemView.PositionAtTop)
 
     @QtCore.pyqtSlot()
     def selection_changed(self):
-        count = len(self.file_list_widget.selectedItems())
+        count = len(self.file_list_widget.selectionModel().selectedIndexes())
         self.selected_count.setText(self.tr('%n file(s)\nselected', '', count))
 
     @QtCore.pyqtSlot()
@@ -477,25 +555,32 @@ class Importer(QtWidgets.QWidget):
         self.select_files(since)
 
     def select_files(self, since):
-        count = self.file_list_widget.count()
+        count = self.file_list_model.rowCount()
         if not count:
             return
-        self.file_list_widget.clearSelection()
+        # build selection from contiguous ranges of rows
+        selection = QItemSelection()
         first_active = None
-        for row in range(count):
-            item = self.file_list_widget.item(row)
-            if not (item.flags() & Qt.ItemIsSelectable):
-                continue
-            name = item.text().split()[0]
-            timestamp = self.file_data[name]['timestamp']
-            if timestamp > since:
-                if not first_active:
-                    first_active = item
-                item.setSelected(True)
-        if not first_active:
-            first_active = item
-        self.file_list_widget.scrollToItem(
-            first_active, QtWidgets.QAbstractItemView.PositionAtTop)
+        range_start = None
+        for row in range(count + 1):
+            selected = (row < count and
+                        self.file_list_model.is_selectable(row) and
+                        self.file_list_model.info(row)['timestamp'] > since)
+            if selected and range_start is None:
+                range_start = row
+                if first_active is None:
+                    first_active = row
+            elif not selected and range_start is not None:
+                selection.select(self.file_list_model.index(range_start),
+                                 self.file_list_model.index(row - 1))
+                range_start = None
+        self.file_list_widget.selectionModel().select(
+            selection, QItemSelectionModel.ClearAndSelect)
+        if first_active is None:
+            first_active = count - 1
+        self.file_list_widget.scrollTo(
+            self.file_list_model.index(first_active),
+            QtWidgets.QAbstractItemView.PositionAtTop)
 
     @QtCore.pyqtSlot()
     def copy_selected(self):
@@ -503,12 +588,18 @@ class Importer(QtWidgets.QWidget):
             # user has clicked while import is still cancelling
             self.copy_button.setChecked(False)
             return
-        self.import_in_progress = True
         copy_list = []
-        for item in self.file_list_widget.selectedItems():
-            name = item.text().split()[0]
-            copy_list.append(self.file_data[name])
+        for idx in sorted(
+                self.file_list_widget.selectionModel().selectedIndexes(),
+                key=lambda x: x.row()):
+            copy_list.append(self.file_list_model.info(idx.row()))
+        self.copy_files(copy_list)
+
+    def copy_files(self, copy_list):
+        # returns list of items not copied
+        self.import_in_progress = True
         last_item = None, datetime.min
+        copied = 0
         with self.session() as session:
             with Busy():
                 for item in copy_list:
@@ -519,11 +610,10 @@ class Importer(QtWidgets.QWidget):
                     if not os.path.isdir(dest_dir):
                         os.makedirs(dest_dir)
                     try:
-                        camera_file = session.copy_file(item, dest_path)
+                        session.copy_file(item, dest_path, self.copy_progress)
+                        copied += 1
                         if self.abort_copy():
                             break
-                        if camera_file:
-                            camera_file.save(dest_path)
                     except gp.GPhoto2Error as ex:
                         self.logger.error(str(ex))
                         self._fail()
@@ -542,10 +632,23 @@ class Importer(QtWidgets.QWidget):
                                   last_item[1].isoformat(' '))
             self.image_list.done_opening(last_item[0])
         self.show_file_list()
+        self.selection_changed()
+        stopped = self.abort_copy()
         self.copy_button.setChecked(False)
         self.import_in_progress = False
+        if self.watched_files and not stopped:
+            # import files that arrived during this import
+            QtCore.QTimer.singleShot(0, self.auto_import)
+        return copy_list[copied:]
+
+    def copy_progress(self, done, size):
+        self.selected_count.setText(
+            self.tr('{0}%\ncopied').format(done * 100 // max(size, 1)))
+        return self.abort_copy()
 
     def abort_copy(self):
-        # test if user has stopped copy or quit program
+        # test if user has stopped copy or quit program, the importer
+        # tab needn't be visible as folder watching runs in background
         QtCore.QCoreApplication.processEvents()
-        return not (self.copy_button.isChecked() and self.isVisible())
+        return not (self.copy_button.isChecked() and
+                    self.window().isVisible())
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+##  Photini - a simple photo metadata editor.
+##  http://github.com/jim-easterbrook/Photini
+##  Copyright (C) 2012-17  Jim Easterbrook  jim@jim-easterbrook.me.uk
+##
+##  This program is free software: you can redistribute it and/or
+##  modify it under the terms of the GNU General Public License as
+##  published by the Free Software Foundation, either version 3 of the
+##  License, or (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+##  General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License
+##  along with this program.  If not, see
+##  <http://www.gnu.org/licenses/>.
+
+from datetime import datetime
+import os
+import re
+import shutil
+
+import six
+try:
+    import gphoto2 as gp
+except ImportError:
+    gp = None
+
+from photini.metadata import Metadata
+
+class FolderSource(object):
+    def __init__(self, root, file_types=None):
+        self.root = root
+        if file_types is None:
+            from photini.pyqt import image_types, video_types
+            file_types = image_types() + video_types()
+        self.image_types = ['.' + x for x in file_types]
+        if not os.path.isdir(self.root):
+            raise RuntimeError('Folder not readable')
+
+    def close(self):
+        pass
+
+    def list_files(self):
+        result = []
+        for root, dirs, files in os.walk(self.root):
+            for name in files:
+                base, ext = os.path.splitext(name)
+                if ext.lower() in self.image_types:
+                    result.append(os.path.join(root, name))
+        return result
+
+    def get_file_info(self, path):
+        metadata = Metadata(path, None)
+        timestamp = metadata.date_taken
+        if not timestamp:
+            timestamp = metadata.date_digitised
+        if not timestamp:
+            timestamp = metadata.date_modified
+        if not timestamp:
+            # use file date as last resort
+            timestamp = datetime.fromtimestamp(os.path.getmtime(path))
+        else:
+            timestamp = timestamp.datetime
+        folder, name = os.path.split(path)
+        return {
+            'camera'    : six.text_type(metadata.camera_model),
+            'path'      : path,
+            'name'      : name,
+            'timestamp' : timestamp,
+            }
+
+    def copy_file(self, info, dest, progress=None):
+        shutil.copy2(info['path'], dest)
+        return None
+
+
+class CameraSource(object):
+    # size of blocks read from camera when streaming a file to disk
+    chunk_size = 1024 * 1024
+
+    def __init__(self, model, port_name):
+        self.model = model
+        self.port_name = port_name
+        self.context = gp.Context()
+        self.file_info = {}
+        # initialise camera
+        self.camera = gp.Camera()
+        # search ports for camera port name
+        port_info_list = gp.PortInfoList()
+        port_info_list.load()
+        idx = port_info_list.lookup_path(self.port_name)
+        self.camera.set_port_info(port_info_list[idx])
+        self.camera.init(self.context)
+        # check camera is the right model
+        if self.camera.get_abilities().model != self.model:
+            raise RuntimeError('Camera model mismatch')
+
+    def close(self):
+        # free camera
+        self.camera.exit(self.context)
+
+    def list_files(self):
+        # walk the camera's folders without recursion, fetching file
+        # info while each folder's listing is still in libgphoto2's
+        # filesystem cache
+        result = []
+        self.file_info = {}
+        folders = ['/']
+        while folders:
+            folder = folders.pop(0)
+            for name, value in self.camera.folder_list_files(
+                    folder, self.context):
+                path = os.path.join(folder, name)
+                self.file_info[path] = self._file_info(folder, name)
+                result.append(path)
+            subfolders = []
+            for name, value in self.camera.folder_list_folders(
+                    folder, self.context):
+                subfolders.append(os.path.join(folder, name))
+            folders = subfolders + folders
+        return result
+
+    def _file_info(self, folder, name):
+        info = self.camera.file_get_info(str(folder), str(name), self.context)
+        if info.file.fields & gp.GP_FILE_INFO_SIZE:
+            size = info.file.size
+        else:
+            # some cameras don't report the size
+            size = None
+        return {
+            'camera'    : self.model,
+            'folder'    : folder,
+            'name'      : name,
+            'timestamp' : datetime.utcfromtimestamp(info.file.mtime),
+            'size'      : size,
+            }
+
+    def get_file_info(self, path):
+        if path not in self.file_info:
+            folder, name = os.path.split(path)
+            self.file_info[path] = self._file_info(folder, name)
+        return self.file_info[path]
+
+    def copy_file(self, info, dest, progress=None):
+        if not (info['size'] and hasattr(self.camera, 'file_read')):
+            # old python-gphoto2 or unknown size, fetch whole file
+            # into memory
+            camera_file = self.camera.file_get(
+                info['folder'], info['name'], gp.GP_FILE_TYPE_NORMAL,
+                self.context)
+            camera_file.save(dest)
+            if not os.path.getsize(dest):
+                # an empty file would be treated as already imported
+                os.unlink(dest)
+                raise gp.GPhoto2Error(gp.GP_ERROR_CORRUPTED_DATA)
+            return None
+        # stream file to disk in blocks to limit memory usage
+        size = info['size']
+        buf = bytearray(self.chunk_size)
+        view = memoryview(buf)
+        offset = 0
+        with open(dest, 'wb') as f:
+            while offset < size:
+                count = self.camera.file_read(
+                    info['folder'], info['name'], gp.GP_FILE_TYPE_NORMAL,
+                    offset, view, self.context)
+                if count <= 0:
+                    break
+                f.write(view[:count])
+                offset += count
+                if progress and progress(offset, size):
+                    break
+        if offset < size:
+            # aborted or truncated, don't leave a partial file
+            os.unlink(dest)
+        return None
+
+
+def get_camera_list():
+    if not gp:
+        return []
+    context = gp.Context()
+    camera_list = []
+    for name, addr in context.camera_autodetect():
+        camera_list.append((name, addr))
+    camera_list.sort(key=lambda x: x[0])
+    return camera_list
+
+
+class PathFormat(object):
+    """Compiled importer "target format".
+
+    The format is parsed once into a str.format template, so each
+    transform only needs one strftime and one format call.
+
+    """
+    number_parser = re.compile('\D*(\d+)')
+    keywords = ('camera', 'ext', 'name', 'number', 'root')
+
+    def __init__(self, format_string):
+        self.format_string = format_string
+        # extract bracket delimited words from string
+        self.parts = []
+        while format_string:
+            parts = format_string.split('(', 1)
+            if len(parts) > 1:
+                parts[1:] = parts[1].split(')', 1)
+            if len(parts) < 3:
+                self.parts.append((format_string, ''))
+                break
+            self.parts.append((parts[0], parts[1]))
+            format_string = parts[2]
+        self.template = ''
+        self.used_keywords = set()
+        for left, right in self.parts:
+            self.template += left.replace('{', '{{').replace('}', '}}')
+            if right in self.keywords:
+                self.template += '{' + right + '}'
+                self.used_keywords.add(right)
+            else:
+                self.template += right.replace('{', '{{').replace('}', '}}')
+
+    def transform(self, file_data):
+        name = file_data['name']
+        subst = {'name': name}
+        subst['root'], subst['ext'] = os.path.splitext(name)
+        if 'number' in self.used_keywords:
+            match = self.number_parser.match(name)
+            if match:
+                subst['number'] = match.group(1)
+            else:
+                subst['number'] = ''
+        if 'camera' in self.used_keywords:
+            subst['camera'] = file_data['camera'] or 'unknown_camera'
+            subst['camera'] = subst['camera'].replace(' ', '_')
+        # do timestamp, then substitute (...) parts
+        return file_data['timestamp'].strftime(self.template).format(**subst)
+
+
+class ExistingFiles(object):
+    # answer "does this file exist" by listing each directory once,
+    # instead of testing every path
+    def __init__(self):
+        self.dir_contents = {}
+
+    def exists(self, path):
+        dir_name, name = os.path.split(path)
+        if dir_name not in self.dir_contents:
+            try:
+                self.dir_contents[dir_name] = set(
+                    map(os.path.normcase, os.listdir(dir_name)))
+            except OSError:
+                self.dir_contents[dir_name] = set()
+        return os.path.normcase(name) in self.dir_contents[dir_name]
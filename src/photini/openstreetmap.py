@@ -19,25 +19,126 @@
 
 from __future__ import unicode_literals
 
+import base64
+from collections import defaultdict, deque
+import itertools
+import json
 import locale
 import os
+import sqlite3
+import time
 import webbrowser
 
+import appdirs
 import requests
 import six
 
 from photini.configstore import key_store
 from photini.photinimap import PhotiniMap
-from photini.pyqt import Busy, Qt, QtCore, QtWidgets, qt_version_info
+from photini.pyqt import QtCore, QtWidgets, qt_version_info
+from photini.tilecache import TileCache, TileLoader, tiles_in_bounds
+
+class GeocodeCache(object):
+    # results older than this (in seconds) are fetched again
+    max_age = 30 * 24 * 3600
+
+    def __init__(self, path=None):
+        if not path:
+            cache_dir = appdirs.user_cache_dir('photini')
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            path = os.path.join(cache_dir, 'opencage_cache.db')
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS results'
+                        ' (key TEXT PRIMARY KEY, response TEXT, fetched REAL)')
+        self.db.execute('DELETE FROM results WHERE fetched < ?',
+                        (time.time() - self.max_age,))
+        self.db.commit()
+
+    def get(self, key):
+        row = self.db.execute(
+            'SELECT response FROM results WHERE key = ?', (key,)).fetchone()
+        if row:
+            return json.loads(row[0])
+        return None
+
+    def set(self, key, rsp):
+        self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                        (key, json.dumps(rsp), time.time()))
+        self.db.commit()
+
+
+class GeocodeWorker(QtCore.QObject):
+    fetch = QtCore.pyqtSignal(int, object)
+    fetch_done = QtCore.pyqtSignal(int, object, six.text_type)
+
+    def __init__(self, url, timeout):
+        super(GeocodeWorker, self).__init__()
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.thread = QtCore.QThread(self)
+        self.moveToThread(self.thread)
+        # emitted from GUI thread, so get_json runs in worker thread
+        self.fetch.connect(self.get_json)
+
+    @QtCore.pyqtSlot(int, object)
+    def get_json(self, request_id, params):
+        try:
+            rsp = self.session.get(
+                self.url, params=params, timeout=self.timeout)
+            rsp = rsp.json()
+        except requests.exceptions.Timeout:
+            self.fetch_done.emit(request_id, None, 'timed out')
+            return
+        except Exception as ex:
+            self.fetch_done.emit(request_id, None, six.text_type(ex))
+            return
+        self.fetch_done.emit(request_id, rsp, '')
+
 
 class OpenStreetMap(PhotiniMap):
+    api_url = 'https://api.opencagedata.com/geocode/v1/json'
+    # reverse geocode results are shared by locations rounded to this
+    # many decimal places (about 11 metres)
+    address_precision = 4
+    # seconds to wait for a response
+    request_timeout = 20
+    tile_url = ('https://cartodb-basemaps-{s}.global.ssl.fastly.net/'
+                'light_all/{z}/{x}/{y}.png')
+    max_zoom = 18
+
     def __init__(self, *arg, **kw):
         super(OpenStreetMap, self).__init__(*arg, **kw)
-        self.block_timer = QtCore.QTimer(self)
-        self.block_timer.setInterval(10000)
-        self.block_timer.setSingleShot(True)
-        self.block_timer.timeout.connect(self.enable_search)
         self.api_key = key_store.get('opencagedata', 'api_key')
+        self.geocode_cache = GeocodeCache()
+        # queued requests, sent no faster than the rate limit allows
+        self.geocode_queue = deque()
+        self.request_timer = QtCore.QTimer(self)
+        self.request_timer.setSingleShot(True)
+        self.request_timer.timeout.connect(self.next_request)
+        self.request_interval = 1.0
+        self.next_request_time = 0.0
+        self.next_request_id = 0
+        self.request_active = None
+        # HTTP requests are made in a separate thread
+        self.geocode_worker = GeocodeWorker(self.api_url, self.request_timeout)
+        self.geocode_worker.fetch_done.connect(self.fetch_done)
+        self.geocode_worker.thread.start()
+        # map tiles are fetched by Python so they can be cached
+        cache_size = int(self.config_store.get('map', 'tile_cache_size', '200'))
+        self.tile_loader = TileLoader(
+            self.tile_url, TileCache('carto_light', cache_size * 1000000),
+            parent=self)
+        self.tile_loader.tile_ready.connect(self.tile_ready)
+        self.tile_loader.tile_failed.connect(self.tile_failed)
+        # tiles waiting to be sent to the map in one call
+        self.tile_results = []
+        self.tile_timer = QtCore.QTimer(self)
+        self.tile_timer.setSingleShot(True)
+        self.tile_timer.setInterval(0)
+        self.tile_timer.timeout.connect(self.send_tiles)
+        QtWidgets.QApplication.instance().aboutToQuit.connect(self.shutdown)
 
     def get_page_elements(self):
         return {
@@ -99,63 +200,191 @@ class OpenStreetMap(PhotiniMap):
     def load_tou_tiles(self):
         webbrowser.open_new('https://carto.com/attribution')
 
-    @QtCore.pyqtSlot()
-    def enable_search(self):
-        self.edit_box.lineEdit().setEnabled(self.map_loaded)
-        if self.search_string:
-            item = self.edit_box.model().item(1)
-            item.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEnabled)
-        self.display_coords()
-
-    def disable_search(self):
-        self.edit_box.lineEdit().setEnabled(False)
-        if self.search_string:
-            item = self.edit_box.model().item(1)
-            item.setFlags(~(Qt.ItemIsSelectable | Qt.ItemIsEnabled))
-        self.auto_location.setEnabled(False)
-        self.block_timer.start()
-
-    def do_search(self, query, params={}):
-        self.disable_search()
-        params['key'] = self.api_key
+    def do_search(self, kind, query, callback, params={}):
+        # get result from cache, or queue a request to OpenCage
+        params = dict(params)
         params['q'] = query
         params['abbrv'] = '1'
         params['no_annotations'] = '1'
         lang, encoding = locale.getdefaultlocale()
         if lang:
             params['language'] = lang
-        with Busy():
-            try:
-                rsp = requests.get(
-                    'https://api.opencagedata.com/geocode/v1/json',
-                    params=params)
-            except Exception as ex:
-                self.logger.error(str(ex))
-                return None
-        if rsp.status_code >= 400:
-            self.logger.error('Search error %d', rsp.status_code)
-            return None
-        rsp = rsp.json()
-        status = rsp['status']
-        if status['code'] != 200:
-            self.logger.error(
-                'Search error %d: %s', status['code'], status['message'])
-            return None
-        rate = rsp['rate']
-        self.block_timer.setInterval(
-            10000 * rate['limit'] // max(rate['remaining'], 1))
-        return rsp
+        key = json.dumps(params, sort_keys=True)
+        rsp = self.geocode_cache.get(key)
+        if rsp:
+            callback(rsp)
+            return
+        if kind == 'search':
+            # a new search supersedes any earlier one
+            self.cancel_requests(kind)
+        self.next_request_id += 1
+        self.geocode_queue.append(
+            [self.next_request_id, kind, key, params, callback])
+        self.schedule_request()
+
+    def cancel_requests(self, kind):
+        self.geocode_queue = deque(
+            [x for x in self.geocode_queue if x[1] != kind])
+        if self.request_active and self.request_active[1] == kind:
+            # can't stop the request, but can ignore the result
+            self.request_active[4] = None
+
+    def schedule_request(self):
+        if (self.request_timer.isActive() or self.request_active or
+                not self.geocode_queue):
+            return
+        delay = max(self.next_request_time - time.time(), 0.0)
+        self.request_timer.start(int(delay * 1000.0))
 
     @QtCore.pyqtSlot()
-    def get_address(self):
-        lat, lon = self.coords.get_value().split(',')
-        rsp = self.do_search(lat.strip() + ' ' + lon.strip())
-        if not rsp:
+    def next_request(self):
+        if not self.geocode_queue:
+            return
+        request = self.geocode_queue.popleft()
+        request_id, kind, key, params, callback = request
+        # an earlier request in the queue may have fetched the same data
+        rsp = self.geocode_cache.get(key)
+        if rsp:
+            self.schedule_request()
+            callback(rsp)
             return
+        self.next_request_time = time.time() + self.request_interval
+        self.request_active = request
+        params = dict(params)
+        params['key'] = self.api_key
+        self.geocode_worker.fetch.emit(request_id, params)
+
+    @QtCore.pyqtSlot(int, object, six.text_type)
+    def fetch_done(self, request_id, rsp, error):
+        request_id, kind, key, params, callback = self.request_active
+        self.request_active = None
+        if error:
+            self.logger.error('Search error: %s', error)
+        else:
+            self.set_rate_limit(rsp)
+            status = rsp['status']
+            if status['code'] != 200:
+                self.logger.error('Search error %d: %s',
+                                  status['code'], status['message'])
+                rsp = None
+            else:
+                self.geocode_cache.set(key, rsp)
+        self.schedule_request()
+        if rsp and callback:
+            callback(rsp)
+
+    @QtCore.pyqtSlot()
+    def shutdown(self):
+        self.geocode_worker.thread.quit()
+        self.geocode_worker.thread.wait()
+        self.tile_loader.shutdown()
+
+    @QtCore.pyqtSlot(six.text_type)
+    def request_tile(self, key):
+        self.tile_loader.get_tile(key)
+
+    @QtCore.pyqtSlot(six.text_type)
+    def release_tile(self, key):
+        self.tile_loader.release_tile(key)
+
+    @QtCore.pyqtSlot(six.text_type, object)
+    def tile_ready(self, key, data):
+        self.tile_results.append((key, 'data:image/png;base64,' +
+                                  base64.b64encode(data).decode('ascii')))
+        self.tile_timer.start()
+
+    @QtCore.pyqtSlot(six.text_type)
+    def tile_failed(self, key):
+        self.tile_results.append((key, None))
+        self.tile_timer.start()
+
+    @QtCore.pyqtSlot()
+    def send_tiles(self):
+        if not self.map_loaded:
+            # page asks for tiles before initialize_finished is called
+            return
+        results, self.tile_results = self.tile_results, []
+        if results:
+            self.JavaScript('tilesReady({})'.format(json.dumps(results)))
+
+    @QtCore.pyqtSlot()
+    def initialize_finished(self):
+        super(OpenStreetMap, self).initialize_finished()
+        self.send_tiles()
+
+    @QtCore.pyqtSlot(QtCore.QVariant)
+    def new_status(self, status):
+        super(OpenStreetMap, self).new_status(status)
+        self.prefetch_tiles()
+
+    def prefetch_tiles(self):
+        # get tiles the user is likely to want next, nearest first
+        self.tile_loader.clear_prefetch()
+        zoom = self.map_zoom
+        bounds = self.map_status['bounds']
+        keys = [tiles_in_bounds(*bounds, zoom=zoom, margin=2)]
+        if zoom > 0:
+            keys.append(tiles_in_bounds(*bounds, zoom=zoom - 1, margin=1))
+        if zoom < self.max_zoom:
+            keys.append(tiles_in_bounds(*bounds, zoom=zoom + 1))
+        # area around selected images
+        locations = set()
+        for image in self.image_list.get_selected_images():
+            if image in self.image_marker:
+                locations.add(self.marker_location[self.image_marker[image]])
+        if locations:
+            lats, lons = zip(*locations)
+            keys.append(tiles_in_bounds(
+                max(lats), max(lons), min(lats), min(lons),
+                zoom=zoom, margin=1))
+        self.tile_loader.prefetch(itertools.chain(*keys))
+
+    def set_rate_limit(self, rsp):
+        # spread remaining requests out as the daily allowance is used
+        now = time.time()
+        rate = rsp.get('rate')
+        if not rate:
+            if rsp['status']['code'] == 429:
+                self.next_request_time = now + 60.0
+            return
+        if rate['remaining'] <= 0:
+            self.next_request_time = max(rate['reset'], now + 1.0)
+            self.logger.warning('Geocoding paused until %s',
+                                time.strftime('%H:%M', time.localtime(
+                                    self.next_request_time)))
+            return
+        self.request_interval = max(
+            1.0, float(rate['limit']) / float(rate['remaining']))
+        self.next_request_time = now + self.request_interval
+
+    def display_coords(self):
+        super(OpenStreetMap, self).display_coords()
+        # can look up addresses of several locations at once
+        self.auto_location.setEnabled(
+            self.map_loaded and self.selection_summary()['has_latlong'])
+
+    @QtCore.pyqtSlot()
+    def get_address(self):
+        # group images by rounded location so each location is only
+        # looked up once
+        cells = defaultdict(list)
+        for image in self.image_list.get_selected_images():
+            latlong = image.metadata.latlong
+            if not latlong:
+                continue
+            cells[(round(latlong.lat, self.address_precision),
+                   round(latlong.lon, self.address_precision))].append(image)
+        for (lat, lon), images in cells.items():
+            def callback(rsp, images=images):
+                self.set_address(images, rsp)
+            self.do_search('address', '{:.{p}f} {:.{p}f}'.format(
+                lat, lon, p=self.address_precision), callback)
+
+    def set_address(self, images, rsp):
         if rsp['total_results'] < 1:
             self.logger.error('Address not found')
             return
-        address = rsp['results'][0]['components']
+        address = dict(rsp['results'][0]['components'])
         location = []
         for iptc_key, osm_keys in (
                 ('world_region',   ()),
@@ -183,7 +412,14 @@ class OpenStreetMap(PhotiniMap):
             if key in ('postcode', 'state_code', '_type'):
                 continue
             location[-1] = '{}: {}, {}'.format(key, address[key], location[-1])
-        self.set_location_taken(*location)
+        world_region, country_code, country_name, province_state, city, \
+            sublocation = location
+        for image in images:
+            image.metadata.location_taken = (
+                sublocation, city, province_state,
+                country_name, country_code, world_region)
+        self.invalidate_summary()
+        self.display_location()
 
     @QtCore.pyqtSlot()
     def search(self, search_string=None):
@@ -204,10 +440,12 @@ class OpenStreetMap(PhotiniMap):
                       lon + w, min(lat + h,  90.0))
         else:
             bounds = (bounds[3], bounds[2], bounds[1], bounds[0])
-        rsp = self.do_search(
-            search_string, {'bounds': ','.join(map(str, bounds))})
-        if not rsp:
-            return
+        # round bounds so repeated searches can use cached results
+        self.do_search(
+            'search', search_string, self.show_search_results,
+            {'bounds': ','.join(['{:.2f}'.format(x) for x in bounds])})
+
+    def show_search_results(self, rsp):
         for result in rsp['results']:
             self.search_result(
                 result['bounds']['northeast']['lat'],
@@ -221,9 +459,9 @@ class OpenStreetMap(PhotiniMap):
         blocked = self.image_list.blockSignals(True)
         self.image_list.select_images(self.marker_images[marker_id])
         self.image_list.blockSignals(blocked)
+        self.invalidate_summary()
         self.coords.setEnabled(True)
-        for other_id, images in self.marker_images.items():
+        for other_id in list(self.marker_state):
             if other_id != marker_id:
-                self.JavaScript('enableMarker({:d},{:d})'.format(
-                    other_id, False))
+                self.marker_op('enable', other_id, False)
         self.display_coords()
@@ -20,7 +20,10 @@
 from __future__ import unicode_literals
 
 from collections import defaultdict
+from datetime import datetime
+import json
 import logging
+import math
 import os
 import webbrowser
 
@@ -29,8 +32,10 @@ import six
 
 from photini.imagelist import DRAG_MIMETYPE
 from photini.pyqt import (
-    Qt, QtCore, QtGui, QtWebChannel, QtWebEngineWidgets,
-    QtWebKitWidgets, QtWidgets, set_symbol_font, SingleLineEdit, SquareButton)
+    Busy, Qt, QtCore, QtGui, QtWebChannel, QtWebEngineWidgets,
+    QtWebKitWidgets, QtWidgets, qt_version_info, set_symbol_font,
+    SingleLineEdit, SquareButton)
+from photini.tracklog import TrackLog
 
 translate = QtCore.QCoreApplication.translate
 
@@ -164,7 +169,18 @@ class LocationInfo(QtWidgets.QWidget):
         return self.members[key]
 
 
+# marker for a field that differs between selected images
+MULTIPLE = object()
+
+
 class PhotiniMap(QtWidgets.QSplitter):
+    location_attrs = ('sublocation', 'city', 'province_state',
+                      'country_name', 'country_code', 'world_region')
+    # no clustering at this zoom level or higher
+    cluster_max_zoom = 16
+    # size (in degrees) of the location index grid
+    index_cell = 0.1
+
     def __init__(self, image_list, parent=None):
         super(PhotiniMap, self).__init__(parent)
         self.logger = logging.getLogger(self.__class__.__name__)
@@ -177,7 +193,33 @@ class PhotiniMap(QtWidgets.QSplitter):
             os.path.join(self.script_dir, 'grey_marker.png'))
         self.search_string = None
         self.map_loaded = False
-        self.marker_images = {}
+        self.summary = None
+        self.clear_marker_index()
+        # markers closer than this many pixels are shown as a cluster
+        self.cluster_size = int(
+            self.config_store.get('map', 'cluster_size', '60'))
+        self.map_zoom = 0
+        # marker operations waiting to be sent to the map in one call
+        self.marker_ops = []
+        self.markers_changed = False
+        # marker id -> (lat, lon, active), as last sent to the map
+        self.marker_state = {}
+        # cluster id -> (lat, lon, count, active), as last sent to the map
+        self.cluster_state = {}
+        # grid cell -> cluster id, and cluster id -> marker ids
+        self.cluster_ids = {}
+        self.cluster_markers = {}
+        self.next_cluster_id = 0
+        self.marker_timer = QtCore.QTimer(self)
+        self.marker_timer.setSingleShot(True)
+        self.marker_timer.setInterval(0)
+        self.marker_timer.timeout.connect(self.send_marker_ops)
+        # marker drag position waiting to be written to metadata
+        self.drag_position = None
+        self.drag_timer = QtCore.QTimer(self)
+        self.drag_timer.setSingleShot(True)
+        self.drag_timer.setInterval(500)
+        self.drag_timer.timeout.connect(self.commit_drag)
         self.map_status = {}
         self.dropped_images = []
         self.setChildrenCollapsible(False)
@@ -231,6 +273,12 @@ class PhotiniMap(QtWidgets.QSplitter):
         self.auto_location.setEnabled(False)
         self.auto_location.clicked.connect(self.get_address)
         self.grid.addWidget(self.auto_location, 1, 2)
+        # set lat/lng from GPS track log
+        self.track_button = QtWidgets.QPushButton(
+            translate('PhotiniMap', 'Load GPS track'))
+        self.track_button.setEnabled(False)
+        self.track_button.clicked.connect(self.load_track)
+        self.grid.addWidget(self.track_button, 2, 1, 1, 2)
         # location info
         self.location_info = LocationInfo()
         self.location_info['taken'].new_value.connect(self.new_location_taken)
@@ -266,6 +314,7 @@ class PhotiniMap(QtWidgets.QSplitter):
 
     @QtCore.pyqtSlot()
     def image_list_changed(self):
+        self.invalidate_summary()
         self.redraw_markers()
         self.display_coords()
         self.display_location()
@@ -339,10 +388,13 @@ class PhotiniMap(QtWidgets.QSplitter):
         self.edit_box.setEnabled(True)
         self.map.setAcceptDrops(True)
         self.image_list.set_drag_to_map(self.drag_icon)
+        self.map_zoom = int(eval(self.config_store.get('map', 'zoom')))
         self.redraw_markers()
         self.display_coords()
 
     def refresh(self):
+        # location may have been edited on another tab
+        self.invalidate_summary()
         self.setSizes(
             eval(self.app.config_store.get('map', 'split', str(self.sizes()))))
         if not self.map_loaded:
@@ -361,6 +413,8 @@ class PhotiniMap(QtWidgets.QSplitter):
         self.map_status = status
         self.config_store.set('map', 'centre', str(self.map_status['centre']))
         self.config_store.set('map', 'zoom', str(int(self.map_status['zoom'])))
+        self.map_zoom = int(self.map_status['zoom'])
+        self.update_markers()
 
     @QtCore.pyqtSlot(int, int, six.text_type)
     def drop_text(self, x, y, text):
@@ -385,6 +439,7 @@ class PhotiniMap(QtWidgets.QSplitter):
             for image in self.image_list.get_selected_images():
                 self._remove_image(image)
                 image.metadata.latlong = None
+            self.invalidate_summary()
             return
         try:
             lat, lng = map(float, text.split(','))
@@ -398,18 +453,71 @@ class PhotiniMap(QtWidgets.QSplitter):
         self.display_coords()
         self.see_selection()
 
+    @QtCore.pyqtSlot()
+    def load_track(self):
+        images = [x for x in self.image_list.get_selected_images()
+                  if x.metadata.date_taken]
+        if not images:
+            self.logger.error('No selected images have a date & time')
+            return
+        paths = QtWidgets.QFileDialog.getOpenFileNames(
+            self, translate('PhotiniMap', 'Load GPS track'),
+            self.config_store.get('paths', 'tracks', ''),
+            translate('PhotiniMap',
+                      'GPS track files (*.gpx *.nmea *.log);;All files (*)'))
+        if qt_version_info >= (5, 0):
+            paths = paths[0]
+        if not paths:
+            return
+        self.config_store.set('paths', 'tracks', os.path.dirname(paths[0]))
+        track = TrackLog()
+        with Busy():
+            for path in paths:
+                try:
+                    track.load(path)
+                except Exception as ex:
+                    self.logger.error('%s: %s', path, str(ex))
+        if not track.times:
+            self.logger.error('No GPS positions found')
+            return
+        date_times = [x.metadata.date_taken for x in images]
+        default_offset = 0
+        if any([x.tz_offset is None for x in date_times]):
+            # assume camera clock was set to local time
+            local = (datetime.now() - datetime.utcnow()).total_seconds()
+            offset, OK = QtWidgets.QInputDialog.getDouble(
+                self, translate('PhotiniMap', 'Photini: time zone'),
+                translate('PhotiniMap', 'Hours ahead of UTC for images'
+                          ' with no time zone'),
+                round(local / 900.0) / 4.0, -14.0, 14.0, 2)
+            if not OK:
+                return
+            default_offset = int(round(offset * 60.0))
+        # find all the positions, then update metadata
+        positions = track.positions(date_times, default_offset)
+        count = 0
+        for image, position in zip(images, positions):
+            if not position:
+                continue
+            self._remove_image(image)
+            self._set_metadata(image, *position)
+            self._add_image(image)
+            count += 1
+        self.logger.info('Set location of %d of %d images', count, len(images))
+        self.display_coords()
+        self.see_selection()
+
     def see_selection(self):
-        locations = []
+        marker_ids = set()
         for image in self.image_list.get_selected_images():
-            latlong = image.metadata.latlong
-            if not latlong:
-                continue
-            location = [latlong.lat, latlong.lon]
-            if location not in locations:
-                locations.append(location)
-        if not locations:
+            if image in self.image_marker:
+                marker_ids.add(self.image_marker[image])
+        if not marker_ids:
             return
-        self.JavaScript('fitPoints({})'.format(repr(locations)))
+        # send corners of bounding box, not every location
+        lats, lons = zip(*[self.marker_location[x] for x in marker_ids])
+        self.JavaScript('fitPoints({})'.format(json.dumps(
+            [[max(lats), max(lons)], [min(lats), min(lons)]])))
 
     @QtCore.pyqtSlot(six.text_type, six.text_type, six.text_type,
                      six.text_type, six.text_type, six.text_type)
@@ -419,6 +527,7 @@ class PhotiniMap(QtWidgets.QSplitter):
             image.metadata.location_taken = (
                 sublocation, city, province_state,
                 country_name, country_code, world_region)
+        self.invalidate_summary()
         self.display_location()
 
     @QtCore.pyqtSlot()
@@ -432,6 +541,7 @@ class PhotiniMap(QtWidgets.QSplitter):
                 shown = shown.value
             image.metadata.location_taken = shown
             image.metadata.location_shown = taken
+        self.invalidate_summary()
         self.display_location()
 
     @QtCore.pyqtSlot(six.text_type, six.text_type)
@@ -448,51 +558,80 @@ class PhotiniMap(QtWidgets.QSplitter):
             if location:
                 new_value = dict(location.value)
             else:
-                new_value = dict.fromkeys((
-                    'sublocation', 'city', 'province_state',
-                    'country_name', 'country_code', 'world_region'))
+                new_value = dict.fromkeys(self.location_attrs)
             new_value[key] = value
             if not any(new_value.values()):
                 new_value = None
             setattr(image.metadata, taken_shown, new_value)
+        self.invalidate_summary()
         self.display_location()
 
-    def display_coords(self):
+    def invalidate_summary(self):
+        # call after changing selection or location metadata
+        self.summary = None
+
+    def selection_summary(self):
+        # common value (or MULTIPLE) of every location field of the
+        # selected images, computed in one pass and kept until the
+        # selection or metadata changes
+        if self.summary is not None:
+            return self.summary
         images = self.image_list.get_selected_images()
-        if not images:
+        summary = {'count': len(images), 'has_latlong': False}
+        undecided = []
+        for image in images:
+            md = image.metadata
+            values = {'latlong': md.latlong}
+            for taken_shown in 'taken', 'shown':
+                location = getattr(md, 'location_' + taken_shown)
+                if location:
+                    location = location.value
+                for attr in self.location_attrs:
+                    values[(taken_shown, attr)] = (
+                        location[attr] if location else None)
+            summary['has_latlong'] = summary['has_latlong'] or bool(
+                values['latlong'])
+            if not undecided:
+                if len(summary) > 2:
+                    # every field already has multiple values
+                    if summary['has_latlong']:
+                        break
+                    continue
+                summary.update(values)
+                undecided = list(values)
+                continue
+            for key in list(undecided):
+                if values[key] != summary[key]:
+                    summary[key] = MULTIPLE
+                    undecided.remove(key)
+        self.summary = summary
+        return summary
+
+    def display_coords(self):
+        summary = self.selection_summary()
+        if not summary['count']:
             self.coords.set_value(None)
             self.auto_location.setEnabled(False)
             return
-        latlong = images[0].metadata.latlong
-        for image in images[1:]:
-            if image.metadata.latlong != latlong:
-                self.coords.set_multiple()
-                self.auto_location.setEnabled(False)
-                return
+        latlong = summary['latlong']
+        if latlong is MULTIPLE:
+            self.coords.set_multiple()
+            self.auto_location.setEnabled(False)
+            return
         self.coords.set_value(latlong)
         self.auto_location.setEnabled(self.map_loaded and bool(latlong))
 
     def display_location(self):
-        images = self.image_list.get_selected_images()
-        if not images:
-            for widget_group in (self.location_info['taken'],
-                                 self.location_info['shown']):
-                for attr in widget_group.members:
-                    widget_group[attr].set_value(None)
-            return
+        summary = self.selection_summary()
         for taken_shown in 'taken', 'shown':
             widget_group = self.location_info[taken_shown]
             for attr in widget_group.members:
-                value = getattr(images[0].metadata, 'location_' + taken_shown)
-                if value:
-                    value = value.value[attr]
-                for image in images[1:]:
-                    other = getattr(image.metadata, 'location_' + taken_shown)
-                    if other:
-                        other = other.value[attr]
-                    if other != value:
-                        widget_group[attr].set_multiple()
-                        break
+                if not summary['count']:
+                    widget_group[attr].set_value(None)
+                    continue
+                value = summary[(taken_shown, attr)]
+                if value is MULTIPLE:
+                    widget_group[attr].set_multiple()
                 else:
                     widget_group[attr].set_value(value)
 
@@ -500,18 +639,34 @@ class PhotiniMap(QtWidgets.QSplitter):
     def new_selection(self, selection):
         self.coords.setEnabled(bool(selection))
         self.location_info.setEnabled(bool(selection))
-        for marker_id, images in self.marker_images.items():
-            self.JavaScript('enableMarker({:d},{:d})'.format(
-                marker_id, any([image.selected for image in images])))
+        self.track_button.setEnabled(bool(selection))
+        self.invalidate_summary()
+        self.update_markers()
         self.display_coords()
         self.display_location()
         self.see_selection()
 
-    def redraw_markers(self):
-        self.JavaScript('removeMarkers()')
+    def clear_marker_index(self):
+        # marker id -> list of images
         self.marker_images = {}
+        # marker id -> (lat, lon) and the reverse
+        self.marker_location = {}
+        self.location_marker = {}
+        # image -> marker id
+        self.image_marker = {}
+        # location index grid cell -> set of marker ids
+        self.marker_grid = defaultdict(set)
+        # marker ids available for reuse
+        self.free_marker_ids = []
+        self.next_marker_id = 0
+
+    def redraw_markers(self):
+        self.marker_ops = []
+        self.marker_op('clear')
+        self.clear_marker_index()
         for image in self.image_list.get_images():
             self._add_image(image)
+        self.update_markers()
 
     def _add_image(self, image):
         if not self.map_loaded:
@@ -519,37 +674,199 @@ class PhotiniMap(QtWidgets.QSplitter):
         latlong = image.metadata.latlong
         if not latlong:
             return
-        for marker_id in self.marker_images:
-            if self.marker_images[marker_id][0].metadata.latlong == latlong:
-                self.marker_images[marker_id].append(image)
-                if image.selected:
-                    self.JavaScript(
-                        'enableMarker({:d},{:d})'.format(marker_id, True))
-                break
+        # LatLon values are already rounded to 6 decimal places
+        location = latlong.lat, latlong.lon
+        marker_id = self.location_marker.get(location)
+        if marker_id is not None:
+            self.marker_images[marker_id].append(image)
+            self.image_marker[image] = marker_id
+            self.update_markers()
+            return
+        if self.free_marker_ids:
+            marker_id = self.free_marker_ids.pop()
         else:
-            for i in range(len(self.marker_images) + 2):
-                marker_id = i
-                if marker_id not in self.marker_images:
-                    break
-            self.marker_images[marker_id] = [image]
-            self.JavaScript('addMarker({:d},{!r},{!r},{:d})'.format(
-                marker_id, latlong.lat, latlong.lon,
-                image.selected))
+            marker_id = self.next_marker_id
+            self.next_marker_id += 1
+        self.marker_images[marker_id] = [image]
+        self.marker_location[marker_id] = location
+        self.location_marker[location] = marker_id
+        self.marker_grid[self.index_key(*location)].add(marker_id)
+        self.image_marker[image] = marker_id
+        self.update_markers()
 
     def _remove_image(self, image):
-        for marker_id in self.marker_images:
-            if image in self.marker_images[marker_id]:
-                break
-        else:
+        marker_id = self.image_marker.pop(image, None)
+        if marker_id is None:
             return
         self.marker_images[marker_id].remove(image)
+        self.update_markers()
         if self.marker_images[marker_id]:
-            self.JavaScript('enableMarker({:d},{:d})'.format(
-                marker_id,
-                any([image.selected for image in self.marker_images[marker_id]])))
+            return
+        del self.marker_images[marker_id]
+        location = self.marker_location.pop(marker_id)
+        if self.location_marker.get(location) == marker_id:
+            del self.location_marker[location]
+        self._unindex_marker(marker_id, location)
+        self.free_marker_ids.append(marker_id)
+
+    def _move_marker(self, marker_id):
+        # update location index after a marker has been dragged
+        old_location = self.marker_location[marker_id]
+        if self.location_marker.get(old_location) == marker_id:
+            del self.location_marker[old_location]
+        self._unindex_marker(marker_id, old_location)
+        latlong = self.marker_images[marker_id][0].metadata.latlong
+        location = latlong.lat, latlong.lon
+        self.marker_location[marker_id] = location
+        self.marker_grid[self.index_key(*location)].add(marker_id)
+        if location not in self.location_marker:
+            self.location_marker[location] = marker_id
+        # the map has already moved the marker
+        if marker_id in self.marker_state:
+            active = self.marker_state[marker_id][2]
+            self.marker_state[marker_id] = location + (active,)
+
+    def index_key(self, lat, lon):
+        return (int(math.floor(lat / self.index_cell)),
+                int(math.floor(lon / self.index_cell)))
+
+    def _unindex_marker(self, marker_id, location):
+        key = self.index_key(*location)
+        self.marker_grid[key].discard(marker_id)
+        if not self.marker_grid[key]:
+            del self.marker_grid[key]
+
+    def view_bounds(self, margin=0.0):
+        # current map bounds (north, east, south, west), optionally
+        # extended by a fraction of the map size on each side
+        if 'bounds' not in self.map_status:
+            return None
+        north, east, south, west = self.map_status['bounds']
+        width = east - west
+        if width < 0.0:
+            # bounds cross the 180 degree meridian
+            width += 360.0
+        height = north - south
+        if width * (1.0 + (2.0 * margin)) >= 360.0:
+            east, west = 180.0, -180.0
         else:
-            self.JavaScript('delMarker({:d})'.format(marker_id))
-            del self.marker_images[marker_id]
+            east = ((east + (width * margin) + 180.0) % 360.0) - 180.0
+            west = ((west - (width * margin) + 180.0) % 360.0) - 180.0
+        north = min(north + (height * margin), 90.0)
+        south = max(south - (height * margin), -90.0)
+        return north, east, south, west
+
+    def markers_in_bounds(self, north, east, south, west):
+        if west <= east:
+            lon_ranges = [(west, east)]
+        else:
+            # bounds cross the 180 degree meridian
+            lon_ranges = [(west, 180.0), (-180.0, east)]
+        row_lo = self.index_key(south, 0)[0]
+        row_hi = self.index_key(north, 0)[0]
+        col_ranges = [(self.index_key(0, lo)[1], self.index_key(0, hi)[1])
+                      for (lo, hi) in lon_ranges]
+        cells = (row_hi + 1 - row_lo) * sum(
+            [hi + 1 - lo for (lo, hi) in col_ranges])
+        candidates = []
+        if cells > len(self.marker_grid):
+            # quicker to test every occupied grid cell
+            for (row, col), marker_ids in self.marker_grid.items():
+                if row < row_lo or row > row_hi:
+                    continue
+                if any([lo <= col <= hi for (lo, hi) in col_ranges]):
+                    candidates += marker_ids
+        else:
+            for row in range(row_lo, row_hi + 1):
+                for lo, hi in col_ranges:
+                    for col in range(lo, hi + 1):
+                        if (row, col) in self.marker_grid:
+                            candidates += self.marker_grid[(row, col)]
+        result = []
+        for marker_id in candidates:
+            lat, lon = self.marker_location[marker_id]
+            if lat < south or lat > north:
+                continue
+            if any([lo <= lon <= hi for (lo, hi) in lon_ranges]):
+                result.append(marker_id)
+        return result
+
+    def update_markers(self):
+        # lay out markers and clusters when control returns to the
+        # event loop
+        if not self.map_loaded:
+            return
+        self.markers_changed = True
+        self.marker_timer.start()
+
+    def grid_cell(self, lat, lon):
+        # position in Web Mercator "world pixels" at current zoom
+        scale = 256.0 * (2 ** self.map_zoom) / self.cluster_size
+        lat = math.radians(max(min(lat, 85.05), -85.05))
+        x = (lon + 180.0) / 360.0
+        y = (1.0 - (math.log(math.tan(lat) + (1.0 / math.cos(lat)))
+                    / math.pi)) / 2.0
+        return int(x * scale), int(y * scale)
+
+    def layout_markers(self):
+        self.markers_changed = False
+        clustering = (self.cluster_size > 0 and
+                      self.map_zoom < self.cluster_max_zoom)
+        # only lay out markers on or near the visible part of the map
+        bounds = self.view_bounds(margin=0.5)
+        if bounds:
+            marker_ids = self.markers_in_bounds(*bounds)
+        else:
+            marker_ids = list(self.marker_images)
+        # group markers by grid cell
+        cells = defaultdict(list)
+        for marker_id in marker_ids:
+            images = self.marker_images[marker_id]
+            lat, lon = self.marker_location[marker_id]
+            active = any([image.selected for image in images])
+            if clustering:
+                cell = self.grid_cell(lat, lon)
+            else:
+                cell = marker_id
+            cells[cell].append((marker_id, lat, lon, active))
+        markers = {}
+        clusters = {}
+        cluster_ids = {}
+        self.cluster_markers = {}
+        for cell, members in cells.items():
+            if len(members) == 1:
+                marker_id, lat, lon, active = members[0]
+                markers[marker_id] = lat, lon, active
+                continue
+            if cell in self.cluster_ids:
+                cluster_id = self.cluster_ids[cell]
+            else:
+                cluster_id = self.next_cluster_id
+                self.next_cluster_id += 1
+            cluster_ids[cell] = cluster_id
+            self.cluster_markers[cluster_id] = [x[0] for x in members]
+            lat = sum([x[1] for x in members]) / len(members)
+            lon = sum([x[2] for x in members]) / len(members)
+            count = sum([len(self.marker_images[x[0]]) for x in members])
+            active = any([x[3] for x in members])
+            clusters[cluster_id] = lat, lon, count, active
+        self.cluster_ids = cluster_ids
+        # send changes to the map
+        for marker_id in list(self.marker_state):
+            if marker_id not in markers:
+                self.marker_op('del', marker_id)
+        for cluster_id in list(self.cluster_state):
+            if cluster_id not in clusters:
+                self.marker_op('uncluster', cluster_id)
+        for marker_id, (lat, lon, active) in markers.items():
+            old = self.marker_state.get(marker_id)
+            if not old or old[:2] != (lat, lon):
+                self.marker_op('add', marker_id, lat, lon, active)
+            else:
+                self.marker_op('enable', marker_id, active)
+        for cluster_id, value in clusters.items():
+            if self.cluster_state.get(cluster_id) != value:
+                self.marker_op('cluster', cluster_id, *value)
 
     @QtCore.pyqtSlot()
     def get_address(self):
@@ -595,16 +912,93 @@ class PhotiniMap(QtWidgets.QSplitter):
     def marker_click(self, marker_id):
         self.image_list.select_images(self.marker_images[marker_id])
 
+    @QtCore.pyqtSlot(int)
+    def cluster_click(self, cluster_id):
+        if cluster_id not in self.cluster_markers:
+            return
+        images = []
+        locations = []
+        for marker_id in self.cluster_markers[cluster_id]:
+            images += self.marker_images[marker_id]
+            locations.append(self.marker_location[marker_id])
+        self.image_list.select_images(images)
+        # zoom in to show the cluster's members
+        lats, lons = zip(*locations)
+        self.JavaScript('adjustBounds({!r},{!r},{!r},{!r})'.format(
+            max(lats), max(lons), min(lats), min(lons)))
+
     @QtCore.pyqtSlot(float, float, int)
     def marker_drag(self, lat, lng, marker_id):
+        # show new position now, but update metadata at a limited rate
+        self.drag_position = lat, lng, marker_id
+        self.coords.set_value('{:.6f}, {:.6f}'.format(lat, lng))
+        if not self.drag_timer.isActive():
+            self.drag_timer.start()
+
+    @QtCore.pyqtSlot(float, float, int)
+    def marker_drag_end(self, lat, lng, marker_id):
+        self.drag_position = lat, lng, marker_id
+        self.commit_drag()
+
+    @QtCore.pyqtSlot()
+    def commit_drag(self):
+        self.drag_timer.stop()
+        if not self.drag_position:
+            return
+        lat, lng, marker_id = self.drag_position
+        self.drag_position = None
+        if marker_id not in self.marker_images:
+            return
         for image in self.marker_images[marker_id]:
             self._set_metadata(image, lat, lng)
+        self._move_marker(marker_id)
         self.display_coords()
 
     def _set_metadata(self, image, lat, lng):
         image.metadata.latlong = lat, lng
+        self.invalidate_summary()
+
+    def marker_op(self, *op):
+        # collect marker operations and send them together when control
+        # returns to the event loop
+        if not self.map_loaded:
+            return
+        if op[0] == 'enable':
+            lat, lon, active = self.marker_state[op[1]]
+            if active == op[2]:
+                # no change
+                return
+            self.marker_state[op[1]] = lat, lon, op[2]
+        elif op[0] == 'add':
+            self.marker_state[op[1]] = op[2:]
+        elif op[0] == 'del':
+            del self.marker_state[op[1]]
+        elif op[0] == 'cluster':
+            self.cluster_state[op[1]] = op[2:]
+        elif op[0] == 'uncluster':
+            del self.cluster_state[op[1]]
+        elif op[0] == 'clear':
+            self.marker_state = {}
+            self.cluster_state = {}
+        self.marker_ops.append(op)
+        self.marker_timer.start()
+
+    @QtCore.pyqtSlot()
+    def send_marker_ops(self):
+        self.marker_timer.stop()
+        if self.markers_changed and self.map_loaded:
+            self.layout_markers()
+        if not self.marker_ops:
+            return
+        ops, self.marker_ops = self.marker_ops, []
+        self._run_java_script('updateMarkers({})'.format(json.dumps(ops)))
 
     def JavaScript(self, command):
+        # keep marker operations in order with other commands
+        self.send_marker_ops()
+        self._run_java_script(command)
+
+    def _run_java_script(self, command):
         if self.map_loaded:
             if QtWebEngineWidgets:
                 self.map.page().runJavaScript(command)
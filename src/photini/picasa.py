@@ -31,7 +31,8 @@ from requests_oauthlib import OAuth2Session
 
 from photini.configstore import key_store
 from photini.pyqt import Busy, MultiLineEdit, Qt, QtCore, QtGui, QtWidgets
-from photini.uploader import PhotiniUploader
+from photini.uploader import (
+    Backoff, PhotiniUploader, retry_upload, use_shared_pool)
 
 logger = logging.getLogger(__name__)
 
@@ -124,6 +125,8 @@ class PicasaSession(object):
         'read' : 'https://picasaweb.google.com/data/',
         'write': 'https://picasaweb.google.com/data/',
         }
+    # resumable upload chunks must be a multiple of 256 KiB
+    chunk_size = 2 * 1024 * 1024
 
     def __init__(self, auto_refresh=True):
         self.auto_refresh = auto_refresh
@@ -164,6 +167,7 @@ class PicasaSession(object):
                     )
             else:
                 self.session = OAuth2Session(client_id, token=self.token)
+            use_shared_pool(self.session)
             self.session.verify = certifi.old_where()
             # refresh manually to get a valid token now
             self.token = self.session.refresh_token(
@@ -183,6 +187,7 @@ class PicasaSession(object):
         self.session = OAuth2Session(
             client_id, scope=self.scope[level],
             redirect_uri='urn:ietf:wg:oauth:2.0:oob')
+        use_shared_pool(self.session)
         self.session.verify = certifi.old_where()
         return self.session.authorization_url(
             'https://accounts.google.com/o/oauth2/v2/auth')[0]
@@ -231,6 +236,63 @@ class PicasaSession(object):
             headers={'Content-Type' : 'image/' + image_type, 'Slug' : title}))
         return PicasaNode(text=resp.text)
 
+    def new_photo_resumable(self, title, album, data, image_type):
+        # start resumable upload session
+        def create_session():
+            return self._check_response(self.session.post(
+                album.get_link('resumable-create-media'),
+                headers={'Slug'                   : title,
+                         'X-Upload-Content-Type'  : 'image/' + image_type,
+                         'X-Upload-Content-Length': str(data.len)}))
+
+        resp = retry_upload(data, create_session)
+        upload_url = resp.headers['Location']
+        # send data in chunks, resuming from wherever the server got to
+        # if a chunk fails
+        backoff = Backoff(data)
+        offset = 0
+        # last offset confirmed by the server, and number of responses
+        # since then that haven't moved the upload on
+        confirmed = 0
+        stalled = 0
+        while True:
+            try:
+                if offset is None or offset >= data.len:
+                    # ask server how much data it has received, or to
+                    # finish the upload if it has all of it
+                    chunk = b''
+                    content_range = 'bytes */{}'.format(data.len)
+                else:
+                    data.seek(offset)
+                    chunk = data.read(self.chunk_size)
+                    content_range = 'bytes {}-{}/{}'.format(
+                        offset, offset + len(chunk) - 1, data.len)
+                resp = self.session.put(
+                    upload_url, data=chunk,
+                    headers={'Content-Range': content_range})
+                if resp.status_code != 308:
+                    resp = self._check_response(resp)
+                    return PicasaNode(text=resp.text)
+                # 308 'Resume Incomplete' says what has been received
+                received = resp.headers.get('Range')
+                if received:
+                    offset = int(received.split('-')[-1]) + 1
+                else:
+                    offset = 0
+                if offset > confirmed:
+                    confirmed = offset
+                    stalled = 0
+                else:
+                    stalled += 1
+                    if stalled > backoff.max_retries:
+                        raise RuntimeError('resumable upload not progressing')
+                if chunk:
+                    backoff.reset()
+            except Exception as ex:
+                if not backoff.retry(ex):
+                    raise
+                offset = None
+
     def get_user(self, feed):
         name = feed.nickname.text
         picture = None
@@ -263,9 +325,14 @@ class PicasaSession(object):
         # upload photo
         title = os.path.basename(image.path)
         try:
-            photo = self.new_photo(title, params, fileobj, image_type)
+            if params.get_link('resumable-create-media'):
+                photo = self.new_photo_resumable(
+                    title, params, fileobj, image_type)
+            else:
+                photo = retry_upload(fileobj, self.new_photo,
+                                     title, params, fileobj, image_type)
         except Exception as ex:
-            return str(ex)
+            return str(ex), None
         # set metadata
 ##        photo.title.text = title
 ##        title = image.metadata.title
@@ -286,8 +353,8 @@ class PicasaSession(object):
 ##        try:
 ##            self.edit_node(photo)
 ##        except Exception as ex:
-##            return str(ex)
-        return ''
+##            return str(ex), None
+        return '', photo.id.text
 
     def _check_response(self, resp):
         if resp.status_code >= 300:
@@ -424,6 +491,8 @@ class PicasaUploadConfig(QtWidgets.QWidget):
 
 class PicasaUploader(PhotiniUploader):
     session_factory = PicasaSession
+    config_section = 'picasa'
+    upload_worker_limits = (2, 4)
 
     def __init__(self, *arg, **kw):
         self.upload_config = PicasaUploadConfig()
@@ -471,6 +540,15 @@ class PicasaUploader(PhotiniUploader):
     def get_upload_params(self):
         return self.current_album
 
+    def save_upload_params(self, params):
+        return params.id.text
+
+    def load_upload_params(self, params):
+        for album in self.get_albums():
+            if album.id.text == params:
+                return album
+        return None
+
     def upload_finished(self):
         # reload current album metadata (to update thumbnail)
         with Busy():
@@ -40,7 +40,7 @@ if using_pyqt5:
 
 if using_pyqt5:
     from PyQt5 import QtGui, QtWidgets
-    from PyQt5.QtCore import Qt
+    from PyQt5.QtCore import Qt, QItemSelection, QItemSelectionModel
     from PyQt5.QtNetwork import QNetworkProxy
     if using_qtwebengine:
         try:
@@ -67,6 +67,7 @@ else:
     QtWebChannel = None
     QtWebEngineWidgets = None
     from PyQt4.QtCore import Qt
+    from PyQt4.QtGui import QItemSelection, QItemSelectionModel
     from PyQt4.QtNetwork import QNetworkProxy
 
 qt_version_info = namedtuple(
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+##  Photini - a simple photo metadata editor.
+##  http://github.com/jim-easterbrook/Photini
+##  Copyright (C) 2012-17  Jim Easterbrook  jim@jim-easterbrook.me.uk
+##
+##  This program is free software: you can redistribute it and/or
+##  modify it under the terms of the GNU General Public License as
+##  published by the Free Software Foundation, either version 3 of the
+##  License, or (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+##  General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License
+##  along with this program.  If not, see
+##  <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import logging
+import math
+import os
+import sqlite3
+import time
+
+import appdirs
+import requests
+import six
+
+from photini.pyqt import QtCore
+
+logger = logging.getLogger(__name__)
+
+
+def tile_xy(lat, lon, zoom):
+    # Web Mercator tile containing a location
+    n = 2 ** zoom
+    lat = math.radians(max(min(lat, 85.05), -85.05))
+    x = int(((lon + 180.0) / 360.0) * n)
+    y = int((1.0 - (math.log(math.tan(lat) + (1.0 / math.cos(lat)))
+                    / math.pi)) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_in_bounds(north, east, south, west, zoom, margin=0):
+    # generate tile keys covering bounds, plus margin tiles all round,
+    # lazily as a large area at high zoom can have millions of tiles
+    n = 2 ** zoom
+    x0, y0 = tile_xy(north, west, zoom)
+    x1, y1 = tile_xy(south, east, zoom)
+    if x1 < x0:
+        # bounds cross the 180 degree meridian
+        x1 += n
+    x0 -= margin
+    x1 += margin
+    if x1 + 1 - x0 > n:
+        x0, x1 = 0, n - 1
+    for y in range(max(y0 - margin, 0), min(y1 + margin, n - 1) + 1):
+        for x in range(x0, x1 + 1):
+            yield '{}/{}/{}'.format(zoom, x % n, y)
+
+
+class TileCache(object):
+    # map tiles stored on disk, least recently used deleted first
+    def __init__(self, name, max_size):
+        self.root = os.path.join(
+            appdirs.user_cache_dir('photini'), 'tiles', name)
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        self.max_size = max_size
+        self.db = sqlite3.connect(os.path.join(self.root, 'index.db'))
+        self.db.execute('CREATE TABLE IF NOT EXISTS tiles'
+                        ' (key TEXT PRIMARY KEY, size INTEGER,'
+                        ' fetched REAL, used REAL)')
+        self.db.commit()
+        self.total_size = self.db.execute(
+            'SELECT SUM(size) FROM tiles').fetchone()[0] or 0
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/')) + '.png'
+
+    def get(self, key):
+        # return tile data and time it was fetched, or (None, None)
+        row = self.db.execute(
+            'SELECT fetched FROM tiles WHERE key = ?', (key,)).fetchone()
+        if not row:
+            return None, None
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+        except IOError:
+            self.db.execute('DELETE FROM tiles WHERE key = ?', (key,))
+            return None, None
+        self.db.execute(
+            'UPDATE tiles SET used = ? WHERE key = ?', (time.time(), key))
+        return data, row[0]
+
+    def contains(self, key):
+        return bool(self.db.execute(
+            'SELECT 1 FROM tiles WHERE key = ?', (key,)).fetchone())
+
+    def put(self, key, data):
+        path = self.path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        row = self.db.execute(
+            'SELECT size FROM tiles WHERE key = ?', (key,)).fetchone()
+        if row:
+            self.total_size -= row[0]
+        now = time.time()
+        self.db.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)',
+                        (key, len(data), now, now))
+        self.total_size += len(data)
+        if self.total_size > self.max_size:
+            self.expire()
+        self.db.commit()
+
+    def expire(self):
+        # delete least recently used tiles to get well within budget
+        target = self.max_size * 0.9
+        deleted = []
+        for key, size in self.db.execute(
+                'SELECT key, size FROM tiles ORDER BY used'):
+            if self.total_size <= target:
+                break
+            try:
+                os.unlink(self.path(key))
+            except OSError:
+                pass
+            self.total_size -= size
+            deleted.append((key,))
+        self.db.executemany('DELETE FROM tiles WHERE key = ?', deleted)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class TileWorker(QtCore.QObject):
+    fetch = QtCore.pyqtSignal(six.text_type, six.text_type)
+    fetch_done = QtCore.pyqtSignal(six.text_type, object, six.text_type)
+
+    def __init__(self, session, timeout):
+        super(TileWorker, self).__init__()
+        self.session = session
+        self.timeout = timeout
+        self.thread = QtCore.QThread(self)
+        self.moveToThread(self.thread)
+        # emitted from GUI thread, so get_tile runs in worker thread
+        self.fetch.connect(self.get_tile)
+
+    @QtCore.pyqtSlot(six.text_type, six.text_type)
+    def get_tile(self, key, url):
+        try:
+            rsp = self.session.get(url, timeout=self.timeout)
+            rsp.raise_for_status()
+        except Exception as ex:
+            self.fetch_done.emit(key, None, six.text_type(ex))
+            return
+        self.fetch_done.emit(key, rsp.content, '')
+
+
+class TileLoader(QtCore.QObject):
+    tile_ready = QtCore.pyqtSignal(six.text_type, object)
+    tile_failed = QtCore.pyqtSignal(six.text_type)
+
+    # tiles older than this (in seconds) are shown, then fetched again
+    max_age = 7 * 24 * 3600
+    # maximum number of tiles waiting to be prefetched
+    max_prefetch = 500
+    # maximum number of keys to look at in one prefetch call
+    max_prefetch_scan = 2000
+    # seconds to wait for a tile
+    timeout = 20
+
+    def __init__(self, url, cache, workers=4, parent=None):
+        super(TileLoader, self).__init__(parent)
+        self.url = url
+        self.cache = cache
+        # tiles the map is waiting for, tiles it might want soon and
+        # old tiles to refresh, in order of priority
+        self.wanted = OrderedDict()
+        self.prefetch_queue = OrderedDict()
+        self.refresh_queue = OrderedDict()
+        self.fetching = {}
+        self.idle_workers = []
+        self.workers = []
+        session = requests.Session()
+        session.mount('https://', requests.adapters.HTTPAdapter(
+            pool_maxsize=workers))
+        for i in range(workers):
+            worker = TileWorker(session, self.timeout)
+            worker.fetch_done.connect(self.fetch_done)
+            worker.thread.start()
+            self.workers.append(worker)
+            self.idle_workers.append(worker)
+
+    def tile_url(self, key):
+        z, x, y = map(int, key.split('/'))
+        return self.url.format(s='abcd'[(x + y) % 4], z=z, x=x, y=y)
+
+    def get_tile(self, key):
+        data, fetched = self.cache.get(key)
+        if data:
+            if fetched < time.time() - self.max_age:
+                # show the old tile while getting a new one
+                self.refresh_queue[key] = True
+                self.start_fetches()
+            self.tile_ready.emit(key, data)
+            return
+        self.wanted[key] = True
+        self.prefetch_queue.pop(key, None)
+        self.start_fetches()
+
+    def release_tile(self, key):
+        # map no longer needs this tile, but it might do later
+        if self.wanted.pop(key, None):
+            self.prefetch_queue[key] = True
+
+    def prefetch(self, keys):
+        # keys can be a generator, only as much of it as needed is used
+        for count, key in enumerate(keys):
+            if (len(self.prefetch_queue) >= self.max_prefetch or
+                    count >= self.max_prefetch_scan):
+                break
+            if (key in self.wanted or key in self.prefetch_queue or
+                    key in self.fetching or self.cache.contains(key)):
+                continue
+            self.prefetch_queue[key] = True
+        self.start_fetches()
+
+    def clear_prefetch(self):
+        self.prefetch_queue.clear()
+
+    def next_key(self):
+        for key in self.wanted:
+            if key not in self.fetching:
+                return key
+        for queue in self.prefetch_queue, self.refresh_queue:
+            while queue:
+                key, dummy = queue.popitem(last=False)
+                if key not in self.fetching:
+                    return key
+        return None
+
+    def start_fetches(self):
+        while self.idle_workers:
+            key = self.next_key()
+            if not key:
+                return
+            worker = self.idle_workers.pop()
+            self.fetching[key] = worker
+            worker.fetch.emit(key, self.tile_url(key))
+
+    @QtCore.pyqtSlot(six.text_type, object, six.text_type)
+    def fetch_done(self, key, data, error):
+        self.idle_workers.append(self.fetching.pop(key))
+        if data:
+            self.cache.put(key, data)
+        else:
+            logger.warning('tile %s: %s', key, error)
+        if self.wanted.pop(key, None):
+            if data:
+                self.tile_ready.emit(key, data)
+            else:
+                self.tile_failed.emit(key)
+        self.start_fetches()
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.thread.quit()
+            worker.thread.wait()
+        self.cache.close()
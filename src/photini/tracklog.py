@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+##  Photini - a simple photo metadata editor.
+##  http://github.com/jim-easterbrook/Photini
+##  Copyright (C) 2012-17  Jim Easterbrook  jim@jim-easterbrook.me.uk
+##
+##  This program is free software: you can redistribute it and/or
+##  modify it under the terms of the GNU General Public License as
+##  published by the Free Software Foundation, either version 3 of the
+##  License, or (at your option) any later version.
+##
+##  This program is distributed in the hope that it will be useful,
+##  but WITHOUT ANY WARRANTY; without even the implied warranty of
+##  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+##  General Public License for more details.
+##
+##  You should have received a copy of the GNU General Public License
+##  along with this program.  If not, see
+##  <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import bisect
+from datetime import datetime, timedelta
+import logging
+import re
+import xml.etree.ElementTree as ET
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def utc_seconds(date_time):
+    return (date_time - EPOCH).total_seconds()
+
+
+class TrackLog(object):
+    """GPS positions from GPX or NMEA files, indexed by time.
+
+    Times are UTC seconds since 1970.
+
+    """
+    # don't interpolate across gaps longer than this (in seconds)
+    max_gap = 600
+    # allow times this far (in seconds) beyond the ends of the track
+    end_tolerance = 60
+
+    gpx_time = re.compile(
+        r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(\.\d+)?'
+        r'(Z|([+-])(\d\d):?(\d\d))?$')
+
+    def __init__(self):
+        self.times = []
+        self.points = []
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            start = f.read(1024).lstrip()
+        if start.startswith(b'<'):
+            points = self.read_gpx(path)
+        else:
+            points = self.read_nmea(path)
+        # merge with existing points and rebuild index
+        points = sorted(list(zip(self.times, self.points)) + points)
+        self.times = [x[0] for x in points]
+        self.points = [x[1] for x in points]
+        return len(points)
+
+    def read_gpx(self, path):
+        # parse incrementally, so large files don't fill memory
+        result = []
+        # open elements, so finished ones can be removed from their parent
+        parents = []
+        for event, elem in ET.iterparse(path, events=('start', 'end')):
+            if event == 'start':
+                parents.append(elem)
+                continue
+            parents.pop()
+            tag = elem.tag.rsplit('}', 1)[-1]
+            if tag != 'trkpt':
+                continue
+            time_elem = None
+            for child in elem:
+                if child.tag.rsplit('}', 1)[-1] == 'time':
+                    time_elem = child
+                    break
+            if time_elem is not None and time_elem.text:
+                timestamp = self.parse_gpx_time(time_elem.text.strip())
+                if timestamp is not None:
+                    result.append((timestamp, (float(elem.get('lat')),
+                                               float(elem.get('lon')))))
+            # elem.clear() alone would leave an empty element attached
+            # to the trkseg for every point
+            if parents:
+                parents[-1].remove(elem)
+        return result
+
+    def parse_gpx_time(self, text):
+        match = self.gpx_time.match(text)
+        if not match:
+            logger.warning('Unrecognised time %s', text)
+            return None
+        parts = match.groups()
+        date_time = datetime(*map(int, parts[:6]))
+        seconds = utc_seconds(date_time)
+        if parts[6]:
+            seconds += float(parts[6])
+        if parts[8]:
+            offset = (int(parts[9]) * 60) + int(parts[10])
+            if parts[8] == '-':
+                offset = -offset
+            seconds -= offset * 60
+        return seconds
+
+    def read_nmea(self, path):
+        # only RMC sentences include the date
+        result = []
+        with open(path, 'rb') as f:
+            for line in f:
+                line = line.decode('ascii', 'ignore').strip()
+                if not line.startswith('$') or line[3:6] != 'RMC':
+                    continue
+                if '*' in line:
+                    line, checksum = line.split('*', 1)
+                    total = 0
+                    for c in line[1:]:
+                        total ^= ord(c)
+                    if '{:02X}'.format(total) != checksum[:2].upper():
+                        continue
+                fields = line.split(',')
+                if len(fields) < 10 or fields[2] != 'A':
+                    continue
+                try:
+                    t, d = fields[1], fields[9]
+                    date_time = datetime(
+                        2000 + int(d[4:6]), int(d[2:4]), int(d[0:2]),
+                        int(t[0:2]), int(t[2:4]), int(t[4:6]))
+                    seconds = utc_seconds(date_time) + float('0' + t[6:])
+                    lat = int(fields[3][:2]) + (float(fields[3][2:]) / 60.0)
+                    if fields[4] == 'S':
+                        lat = -lat
+                    lon = int(fields[5][:3]) + (float(fields[5][3:]) / 60.0)
+                    if fields[6] == 'W':
+                        lon = -lon
+                except (ValueError, IndexError):
+                    continue
+                result.append((seconds, (lat, lon)))
+        return result
+
+    def position(self, timestamp):
+        # interpolated position at timestamp, or None if not known
+        times = self.times
+        if not times:
+            return None
+        idx = bisect.bisect_left(times, timestamp)
+        if idx == 0:
+            if times[0] - timestamp > self.end_tolerance:
+                return None
+            return self.points[0]
+        if idx == len(times):
+            if timestamp - times[-1] > self.end_tolerance:
+                return None
+            return self.points[-1]
+        t0, t1 = times[idx - 1], times[idx]
+        if t1 - t0 > self.max_gap:
+            return None
+        if t1 == t0:
+            return self.points[idx]
+        frac = (timestamp - t0) / (t1 - t0)
+        lat0, lon0 = self.points[idx - 1]
+        lat1, lon1 = self.points[idx]
+        return lat0 + ((lat1 - lat0) * frac), lon0 + ((lon1 - lon0) * frac)
+
+    def positions(self, date_times, default_offset=0):
+        # positions for a list of DateTime values, in the same order
+        result = []
+        for date_taken in date_times:
+            if not date_taken or date_taken.precision < 5:
+                result.append(None)
+                continue
+            offset = date_taken.tz_offset
+            if offset is None:
+                offset = default_offset
+            result.append(self.position(utc_seconds(
+                date_taken.datetime - timedelta(minutes=offset))))
+        return result
@@ -19,56 +19,474 @@
 
 from __future__ import unicode_literals
 
+from collections import OrderedDict
+from datetime import timedelta
+import hashlib
 import imghdr
+import io
+import json
 import logging
 import os
+import random
 import six
 import shutil
+import sqlite3
+import struct
+import tempfile
 import threading
+import time
 import webbrowser
 
 import appdirs
+import requests
 
 from photini.metadata import Metadata
 from photini.pyqt import Busy, Qt, QtCore, QtGui, QtWidgets, StartStopButton
 
+logger = logging.getLogger(__name__)
+
+# connection pool shared by every service session, so connections are
+# kept alive between requests, upload batches and worker threads
+http_adapter = requests.adapters.HTTPAdapter(
+    pool_connections=10, pool_maxsize=8)
+
+def use_shared_pool(session):
+    for prefix in ('https://', 'http://'):
+        session.mount(prefix, http_adapter)
+    return session
+
+# simple requests, e.g. for user icons
+http_session = use_shared_pool(requests.Session())
+
+def parse_schedule(schedule):
+    # convert "08:00-18:00=100, 22:00-06:00=0" (times and kB/s) to a
+    # list of (start minute, end minute, bytes per second)
+    result = []
+    for entry in schedule.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        try:
+            times, rate = entry.split('=')
+            start, end = [x.strip().split(':') for x in times.split('-')]
+            result.append(((int(start[0]) * 60) + int(start[1]),
+                           (int(end[0]) * 60) + int(end[1]),
+                           float(rate) * 1024))
+        except ValueError:
+            logger.error('invalid upload rate schedule entry "%s"', entry)
+    return result
+
+
+class RateLimiter(object):
+    # token bucket, shared by all of a service's upload threads
+    def __init__(self, rate=0, schedule=''):
+        self._lock = threading.Lock()
+        # bytes per second, zero for unlimited
+        self.rate = rate
+        self.schedule = parse_schedule(schedule)
+        self._tokens = 0.0
+        self._last = time.time()
+
+    def current_rate(self):
+        now = time.localtime()
+        minute = (now.tm_hour * 60) + now.tm_min
+        for start, end, rate in self.schedule:
+            if start <= end:
+                if start <= minute < end:
+                    return rate
+            elif minute >= start or minute < end:
+                # period spans midnight
+                return rate
+        return self.rate
+
+    def _refill(self):
+        now = time.time()
+        rate = self.current_rate()
+        if rate:
+            # allow bursts of up to one second
+            self._tokens = min(
+                rate, self._tokens + ((now - self._last) * rate))
+        else:
+            self._tokens = 0.0
+        self._last = now
+        return rate
+
+    def consume(self, size, closing):
+        # take size bytes from the bucket, then wait until it's out of
+        # debt, checking the rate often so it can be changed at any time
+        with self._lock:
+            if self._refill():
+                self._tokens -= size
+        while True:
+            with self._lock:
+                rate = self._refill()
+                if not rate or self._tokens >= 0:
+                    return
+                delay = min(0.5, -self._tokens / rate)
+            if closing.wait(delay):
+                return
+
+
 class FileObjWithCallback(object):
-    def __init__(self, fileobj, callback):
+    # minimum time between progress reports, in seconds
+    report_interval = 0.25
+
+    def __init__(self, fileobj, callback, limiter=None):
         self._f = fileobj
         self._callback = callback
+        self._limiter = limiter
         self._closing = threading.Event()
         # requests library uses 'len' attribute instead of seeking to
         # end of file and back
-        self.len = os.fstat(self._f.fileno()).st_size
+        self._f.seek(0, io.SEEK_END)
+        self.len = self._f.tell()
+        self._f.seek(0)
+        self._last_report = None
+
+    def _report(self, done):
+        # call callback with percentage done and bytes per second, no
+        # more often than necessary to keep the GUI up to date
+        now = time.time()
+        if not self._last_report or done < self._last_report[1]:
+            # starting, or retrying from the beginning
+            self._last_report = now, done, -1, 0.0
+            return
+        last_time, last_done, last_percent, rate = self._last_report
+        percent = done * 100 // max(self.len, 1)
+        if percent == last_percent:
+            return
+        if now - last_time < self.report_interval and done < self.len:
+            return
+        # smooth the transfer rate
+        new_rate = (done - last_done) / max(now - last_time, 0.001)
+        if rate:
+            rate = (rate * 0.7) + (new_rate * 0.3)
+        else:
+            rate = new_rate
+        self._last_report = now, done, percent, rate
+        self._callback(float(percent), rate)
 
     # thread safe close method
     def close(self):
         self._closing.set()
 
+    # wait for delay seconds, return True if closed in the meantime
+    def wait_closed(self, delay):
+        return self._closing.wait(delay)
+
     # substitute read method
     def read(self, size):
         if self._callback:
-            self._callback(self._f.tell() * 100 // self.len)
+            self._report(self._f.tell())
         if self._closing.is_set():
             self._f.close()
-        return self._f.read(size)
+        data = self._f.read(size)
+        if self._limiter and data:
+            self._limiter.consume(len(data), self._closing)
+        return data
 
     # delegate all other attributes to file object
     def __getattr__(self, name):
         return getattr(self._f, name)
 
 
+def is_transient(ex):
+    # network errors and server overload are worth retrying
+    if isinstance(ex, requests.exceptions.HTTPError):
+        return ex.response is not None and (
+            ex.response.status_code >= 500 or ex.response.status_code == 429)
+    return isinstance(ex, (requests.exceptions.ConnectionError,
+                           requests.exceptions.Timeout,
+                           requests.exceptions.ChunkedEncodingError))
+
+
+class Backoff(object):
+    # retry transient errors with "full jitter" exponential backoff
+    max_retries = 4
+    base_delay = 2.0
+    max_delay = 60.0
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.attempt = 0
+
+    def reset(self):
+        self.attempt = 0
+
+    def retry(self, ex):
+        if self.attempt >= self.max_retries or not is_transient(ex):
+            return False
+        delay = random.uniform(
+            0, min(self.max_delay, self.base_delay * (2 ** self.attempt)))
+        self.attempt += 1
+        logger.warning('upload failed (%s), retrying in %.1fs', ex, delay)
+        # don't retry if the upload was aborted while waiting
+        return not self.fileobj.wait_closed(delay)
+
+
+def retry_upload(fileobj, func, *arg, **kw):
+    # call func to upload all of fileobj, retrying if it fails
+    backoff = Backoff(fileobj)
+    while True:
+        fileobj.seek(0)
+        try:
+            return func(*arg, **kw)
+        except Exception as ex:
+            if not backoff.retry(ex):
+                raise
+
+
+def jpeg_segments(data):
+    # split JPEG data into list of (marker, segment) for the APPn and
+    # COM segments at the start, and the rest of the data
+    if data[:2] != b'\xff\xd8':
+        return None, None
+    segments = []
+    pos = 2
+    while pos + 4 <= len(data):
+        ff, marker, length = struct.unpack('>BBH', data[pos:pos + 4])
+        if ff != 0xff or not (0xe0 <= marker <= 0xef or marker == 0xfe):
+            break
+        segments.append((marker, data[pos:pos + 2 + length]))
+        pos += 2 + length
+    return segments, data[pos:]
+
+
+def replace_jpeg_metadata(data, md_data):
+    # replace Exif, XMP (APP1) and IPTC (APP13) segments in data with
+    # those from md_data, keeping any JFIF (APP0) segment first
+    segments, body = jpeg_segments(data)
+    md_segments, md_body = jpeg_segments(md_data)
+    if segments is None or md_segments is None:
+        return None
+    metadata_markers = (0xe1, 0xed)
+    result = [b'\xff\xd8']
+    result += [x[1] for x in segments if x[0] == 0xe0]
+    result += [x[1] for x in md_segments if x[0] in metadata_markers]
+    result += [x[1] for x in segments
+               if x[0] != 0xe0 and x[0] not in metadata_markers]
+    result.append(body)
+    return bytearray().join(result)
+
+
+class UploadQueue(object):
+    # append-only journal of uploads, so that unfinished uploads
+    # survive Photini being closed
+    def __init__(self, name):
+        self.path = os.path.join(
+            appdirs.user_data_dir('photini'), name + '_upload_queue.txt')
+        # batch id -> upload params
+        self.params = {}
+        # item id -> (batch id, path, conversion function name)
+        self.pending = OrderedDict()
+        self.next_id = 0
+        self.records = 0
+        if os.path.exists(self.path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # incomplete record written as Photini stopped
+                    continue
+                self._apply(record)
+        if not self.pending:
+            self._clear()
+
+    def _apply(self, record):
+        op = record['op']
+        if op == 'params':
+            self.params[record['id']] = record['params']
+        elif op == 'add':
+            self.pending[record['id']] = (
+                record['batch'], record['path'], record['convert'])
+        elif op == 'done':
+            self.pending.pop(record['id'], None)
+        self.next_id = max(self.next_id, record['id'] + 1)
+        self.records += 1
+
+    def _write(self, records, path=None):
+        # append records to journal, or write them to a new file
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path or self.path, ('ab', 'wb')[bool(path)]) as f:
+            for record in records:
+                f.write((json.dumps(record) + '\n').encode('utf-8'))
+                if not path:
+                    self._apply(record)
+
+    @staticmethod
+    def _normalise(params):
+        # make params look like they do after reloading, e.g. tuples
+        # become lists
+        return json.loads(json.dumps(params))
+
+    def _clear(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.params = {}
+        self.records = 0
+
+    def _compact(self):
+        # rewrite journal with only the pending uploads
+        batches = set([x[0] for x in self.pending.values()])
+        self.params = dict(
+            [x for x in self.params.items() if x[0] in batches])
+        records = []
+        for batch, params in self.params.items():
+            records.append({'op': 'params', 'id': batch, 'params': params})
+        for item, (batch, path, convert) in self.pending.items():
+            records.append({'op': 'add', 'id': item, 'batch': batch,
+                            'path': path, 'convert': convert})
+        temp_path = self.path + '.tmp'
+        self._write(records, path=temp_path)
+        os.unlink(self.path)
+        os.rename(temp_path, self.path)
+        self.records = len(records)
+
+    def add(self, params, items):
+        # add a batch of (path, conversion function name) items
+        batch = self.next_id
+        params = self._normalise(params)
+        records = [{'op': 'params', 'id': batch, 'params': params}]
+        for n, (path, convert) in enumerate(items):
+            records.append({'op': 'add', 'id': batch + n + 1, 'batch': batch,
+                            'path': path, 'convert': convert})
+        self._write(records)
+        return batch, [x['id'] for x in records[1:]]
+
+    def done(self, items, params=None):
+        items = [x for x in items if x in self.pending]
+        if not items:
+            return
+        batch = self.pending[items[0]][0]
+        records = []
+        if params is not None:
+            params = self._normalise(params)
+        if params is not None and params != self.params.get(batch):
+            # parameters changed, e.g. a new album was created
+            records.append({'op': 'params', 'id': batch, 'params': params})
+        for item in items:
+            records.append({'op': 'done', 'id': item})
+        self._write(records)
+        if not self.pending:
+            self._clear()
+        elif self.records > 1000 and self.records > 4 * len(self.pending):
+            self._compact()
+
+    def next_batch(self):
+        # get oldest batch of pending uploads
+        if not self.pending:
+            return None
+        batch = next(iter(self.pending.values()))[0]
+        items = [(k, v[1], v[2]) for (k, v) in self.pending.items()
+                 if v[0] == batch]
+        return batch, self.params[batch], items
+
+
+class UploadLedger(object):
+    # record of files uploaded to a service, keyed by a hash of the
+    # file's contents so renamed or copied files are recognised
+    def __init__(self, name):
+        data_dir = appdirs.user_data_dir('photini')
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        self.db = sqlite3.connect(os.path.join(data_dir, name + '_uploads.db'))
+        self.db.execute('CREATE TABLE IF NOT EXISTS uploads'
+                        ' (hash TEXT PRIMARY KEY, photo_id TEXT, path TEXT,'
+                        ' uploaded REAL)')
+        # cache of file hashes, to avoid reading unchanged files again
+        self.db.execute('CREATE TABLE IF NOT EXISTS files'
+                        ' (path TEXT PRIMARY KEY, size INTEGER, mtime REAL,'
+                        ' hash TEXT)')
+        self.db.commit()
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        row = self.db.execute(
+            'SELECT hash FROM files WHERE path = ? AND size = ? AND mtime = ?',
+            (path, stat.st_size, stat.st_mtime)).fetchone()
+        if row:
+            return row[0]
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            if f.read(2) == b'\xff\xd8':
+                # ignore JPEG metadata, so editing captions etc. doesn't
+                # change the hash
+                f.seek(0)
+                segments, body = jpeg_segments(f.read())
+                digest.update(body)
+            else:
+                f.seek(0)
+                while True:
+                    data = f.read(1024 * 1024)
+                    if not data:
+                        break
+                    digest.update(data)
+        digest = digest.hexdigest()
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                        (path, stat.st_size, stat.st_mtime, digest))
+        return digest
+
+    def get(self, digest):
+        # return id of uploaded photo, or None
+        row = self.db.execute(
+            'SELECT photo_id FROM uploads WHERE hash = ?', (digest,)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def add(self, digest, photo_id, path):
+        self.db.execute('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?)',
+                        (digest, photo_id, path, time.time()))
+        self.db.commit()
+
+    def commit(self):
+        self.db.commit()
+
+
+class ConvertWorker(QtCore.QObject):
+    convert_next = QtCore.pyqtSignal(int, object, object)
+    convert_done = QtCore.pyqtSignal(int, object, str)
+
+    def __init__(self):
+        super(ConvertWorker, self).__init__()
+        self.thread = QtCore.QThread(self)
+        self.moveToThread(self.thread)
+        # emitted from GUI thread, so convert_file runs in worker thread
+        self.convert_next.connect(self.convert_file)
+
+    @QtCore.pyqtSlot(int, object, object)
+    def convert_file(self, idx, image, convert):
+        try:
+            result = convert(image)
+        except Exception as ex:
+            self.convert_done.emit(idx, None, six.text_type(ex))
+            return
+        self.convert_done.emit(idx, result, '')
+
+
 class UploadWorker(QtCore.QObject):
-    upload_progress = QtCore.pyqtSignal(float)
-    upload_file_done = QtCore.pyqtSignal(object, str)
+    upload_next = QtCore.pyqtSignal(object, object)
+    update_next = QtCore.pyqtSignal(object, object)
+    upload_progress = QtCore.pyqtSignal(float, float)
+    upload_file_done = QtCore.pyqtSignal(object, str, object)
 
-    def __init__(self, session_factory, params):
+    def __init__(self, session_factory, params, limiter):
         super(UploadWorker, self).__init__()
         self.session = session_factory(auto_refresh=False)
         self.params = params
+        self.limiter = limiter
         self.fileobj = None
         self.thread = QtCore.QThread(self)
         self.moveToThread(self.thread)
+        # emitted from GUI thread, so upload_file runs in worker thread
+        self.upload_next.connect(self.upload_file)
+        self.update_next.connect(self.update_metadata)
 
     def abort_upload(self):
         if self.fileobj:
@@ -76,37 +494,56 @@ class UploadWorker(QtCore.QObject):
             self.fileobj = None
 
     @QtCore.pyqtSlot(object, object)
-    def upload_file(self, image, convert):
+    def upload_file(self, image, source):
         if not self.session.permitted('write'):
-            self.upload_file_done.emit(image, 'not permitted')
+            self.upload_file_done.emit(image, 'not permitted', None)
             return
-        if convert:
-            path = convert(image)
+        # source is a file path or converted file data
+        if isinstance(source, bytearray):
+            f = io.BytesIO(source)
+            image_type = imghdr.what(None, h=source)
         else:
-            path = image.path
-        with open(path, 'rb') as f:
-            self.fileobj = FileObjWithCallback(f, self.upload_progress.emit)
-            error = self.session.do_upload(
-                self.fileobj, imghdr.what(path), image, self.params)
-        if convert:
-            os.unlink(path)
+            f = open(source, 'rb')
+            image_type = imghdr.what(source)
+        with f:
+            self.fileobj = FileObjWithCallback(
+                f, self.upload_progress.emit, self.limiter)
+            error, photo_id = self.session.do_upload(
+                self.fileobj, image_type, image, self.params)
         if self.fileobj:
             self.fileobj = None
             # upload wasn't aborted
-            self.upload_file_done.emit(image, error)
+            self.upload_file_done.emit(image, error, photo_id)
+
+    @QtCore.pyqtSlot(object, object)
+    def update_metadata(self, image, photo_id):
+        if not self.session.permitted('write'):
+            self.upload_file_done.emit(image, 'not permitted', None)
+            return
+        error = self.session.do_metadata_update(photo_id, image, self.params)
+        self.upload_file_done.emit(image, error, photo_id)
 
 
 class PhotiniUploader(QtWidgets.QWidget):
-    upload_file = QtCore.pyqtSignal(object, object)
+    # number of files to upload in parallel, (default, maximum)
+    upload_worker_limits = (1, 1)
 
     def __init__(self, upload_config_widget, image_list, *arg, **kw):
         super(PhotiniUploader, self).__init__(*arg, **kw)
         QtWidgets.QApplication.instance().aboutToQuit.connect(self.shutdown)
+        self.config_store = QtWidgets.QApplication.instance().config_store
         self.logger = logging.getLogger(self.__class__.__name__)
         self.image_list = image_list
         self.setLayout(QtWidgets.QGridLayout())
         self.session = self.session_factory()
-        self.upload_worker = None
+        self.upload_workers = []
+        self.convert_workers = []
+        self.temp_dir = None
+        self.upload_queue = UploadQueue(self.config_section)
+        self.ledger = UploadLedger(self.config_section)
+        if self.upload_queue.pending:
+            self.logger.info('%d unfinished uploads will resume when'
+                             ' connected', len(self.upload_queue.pending))
         self.connected = False
         # user details
         self.user = {}
@@ -139,16 +576,39 @@ class PhotiniUploader(QtWidgets.QWidget):
         self.layout().addWidget(QtWidgets.QLabel(self.tr('Progress')), 2, 0)
         self.total_progress = QtWidgets.QProgressBar()
         self.layout().addWidget(self.total_progress, 2, 1, 1, 2)
+        # bandwidth limit
+        self.rate_limiter = RateLimiter(
+            int(self.config_store.get(
+                self.config_section, 'upload_rate', '0')) * 1024,
+            self.config_store.get(
+                self.config_section, 'upload_rate_schedule', ''))
+        self.layout().addWidget(QtWidgets.QLabel(self.tr('Speed limit')), 3, 0)
+        self.upload_rate = QtWidgets.QSpinBox()
+        self.upload_rate.setRange(0, 100000)
+        self.upload_rate.setSingleStep(50)
+        self.upload_rate.setSuffix(' kB/s')
+        self.upload_rate.setSpecialValueText(self.tr('None'))
+        self.upload_rate.setValue(self.rate_limiter.rate // 1024)
+        self.upload_rate.valueChanged.connect(self.new_upload_rate)
+        self.layout().addWidget(self.upload_rate, 3, 1)
         # adjust spacing
         self.layout().setColumnStretch(2, 1)
         self.layout().setRowStretch(0, 1)
 
+    @QtCore.pyqtSlot(int)
+    def new_upload_rate(self, value):
+        # takes effect immediately, even if an upload is in progress
+        self.rate_limiter.rate = value * 1024
+        self.config_store.set(self.config_section, 'upload_rate', str(value))
+
     @QtCore.pyqtSlot()
     def shutdown(self):
-        if self.upload_worker:
-            self.upload_worker.abort_upload()
-            self.upload_worker.thread.quit()
-            self.upload_worker.thread.wait()
+        for worker in self.upload_workers:
+            worker.abort_upload()
+        for worker in self.upload_workers + self.convert_workers:
+            worker.thread.quit()
+            worker.thread.wait()
+        self.remove_temp_dir()
 
     def refresh(self, force=False):
         with Busy():
@@ -168,8 +628,9 @@ class PhotiniUploader(QtWidgets.QWidget):
                 # clearing user data is quick so do it anyway
                 self.load_user_data()
             self.user_connect.setChecked(self.connected)
-            self.upload_config.setEnabled(self.connected and not self.upload_worker)
-            self.user_connect.setEnabled(not self.upload_worker)
+            self.upload_config.setEnabled(
+                self.connected and not self.upload_workers)
+            self.user_connect.setEnabled(not self.upload_workers)
             # enable or disable upload button
             self.new_selection(self.image_list.get_selected_images())
 
@@ -180,16 +641,18 @@ class PhotiniUploader(QtWidgets.QWidget):
         else:
             self.session.log_out()
         self.refresh(force=True)
+        self.resume_upload()
 
     def do_not_close(self):
-        if not self.upload_worker:
+        if not self.upload_workers:
             return False
         dialog = QtWidgets.QMessageBox(parent=self)
         dialog.setWindowTitle(self.tr('Photini: upload in progress'))
         dialog.setText(self.tr('<h3>Upload to {} has not finished.</h3>').format(
             self.service_name))
-        dialog.setInformativeText(
-            self.tr('Closing now will terminate the upload.'))
+        dialog.setInformativeText(self.tr(
+            'Closing now will stop the upload. It will continue the next' +
+            ' time you connect to {}.').format(self.service_name))
         dialog.setIcon(QtWidgets.QMessageBox.Warning)
         dialog.setStandardButtons(
             QtWidgets.QMessageBox.Close | QtWidgets.QMessageBox.Cancel)
@@ -209,11 +672,26 @@ class PhotiniUploader(QtWidgets.QWidget):
             pixmap.loadFromData(picture)
         self.user_photo.setPixmap(pixmap)
 
+    def make_temp_dir(self):
+        # converted files are kept in a per-upload directory, so that
+        # files with the same name can be converted at the same time
+        cache_dir = appdirs.user_cache_dir('photini')
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.temp_dir = tempfile.mkdtemp(prefix='upload_', dir=cache_dir)
+
+    def remove_temp_dir(self):
+        if self.temp_dir:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            self.temp_dir = None
+
     def get_temp_filename(self, image, ext='.jpg'):
-        temp_dir = appdirs.user_cache_dir('photini')
-        if not os.path.isdir(temp_dir):
-            os.makedirs(temp_dir)
-        return os.path.join(temp_dir, os.path.basename(image.path) + ext)
+        name = os.path.basename(image.path)
+        fd, path = tempfile.mkstemp(
+            prefix=os.path.splitext(name)[0] + '_',
+            suffix=ext or os.path.splitext(name)[1], dir=self.temp_dir)
+        os.close(fd)
+        return path
 
     def copy_metadata(self, image, path):
         # copy metadata, forcing IPTC creation
@@ -221,14 +699,37 @@ class PhotiniUploader(QtWidgets.QWidget):
         md.copy(image.metadata)
         md.save(True, 'none', True)
 
-    def convert_to_jpeg(self, image):
-        im = QtGui.QImage(image.path)
+    def add_metadata(self, image, data):
+        # GExiv2 can only save to a file, so write metadata to a tiny
+        # JPEG file and copy its metadata segments into the image data
         path = self.get_temp_filename(image)
-        im.save(path, format='jpeg', quality=95)
+        im = QtGui.QImage(8, 8, QtGui.QImage.Format_RGB32)
+        im.fill(0xffffffff)
+        im.save(path, format='jpeg')
+        self.copy_metadata(image, path)
+        with open(path, 'rb') as f:
+            md_data = f.read()
+        result = replace_jpeg_metadata(data, md_data)
+        if result:
+            os.unlink(path)
+            return result
+        # not a JPEG file, so fall back to writing it to disk
+        with open(path, 'wb') as f:
+            f.write(data)
         self.copy_metadata(image, path)
         return path
 
+    def convert_to_jpeg(self, image):
+        im = QtGui.QImage(image.path)
+        buf = QtCore.QBuffer()
+        buf.open(QtCore.QIODevice.WriteOnly)
+        im.save(buf, format='jpeg', quality=95)
+        return self.add_metadata(image, buf.data().data())
+
     def copy_file_and_metadata(self, image):
+        if image.file_type == 'image/jpeg':
+            with open(image.path, 'rb') as f:
+                return self.add_metadata(image, f.read())
         path = self.get_temp_filename(image, ext='')
         shutil.copyfile(image.path, path)
         self.copy_metadata(image, path)
@@ -286,11 +787,25 @@ class PhotiniUploader(QtWidgets.QWidget):
 
     @QtCore.pyqtSlot()
     def stop_upload(self):
-        if self.upload_worker:
-            # invoke worker method in this thread as worker thread is busy
-            self.upload_worker.abort_upload()
-            # reset GUI
-            self.upload_file_done(None, '')
+        # invoke worker methods in this thread as worker threads are busy
+        for worker in self.upload_workers:
+            worker.abort_upload()
+        self.upload_active = {}
+        # reset GUI
+        with Busy():
+            self.finish_upload()
+
+    def upload_worker_count(self):
+        default, maximum = self.upload_worker_limits
+        count = int(self.config_store.get(
+            self.config_section, 'upload_workers', str(default)))
+        return max(1, min(count, maximum, len(self.upload_list)))
+
+    def convert_worker_count(self):
+        if not any([x[1] for x in self.upload_list]):
+            return 0
+        return max(1, min(self.convert_ahead,
+                          QtCore.QThread.idealThreadCount()))
 
     @QtCore.pyqtSlot()
     def start_upload(self):
@@ -299,11 +814,18 @@ class PhotiniUploader(QtWidgets.QWidget):
             return
         # make list of items to upload
         self.upload_list = []
-        for image in self.image_list.get_selected_images():
-            convert = self.get_conversion_function(image)
-            if convert == 'omit':
-                continue
+        self.upload_photo_ids = []
+        for image, photo_id in self.skip_uploaded(
+                self.image_list.get_selected_images()):
+            if photo_id:
+                # update metadata of previously uploaded photo
+                convert = None
+            else:
+                convert = self.get_conversion_function(image)
+                if convert == 'omit':
+                    continue
             self.upload_list.append((image, convert))
+            self.upload_photo_ids.append(photo_id)
         if not self.upload_list:
             self.upload_button.setChecked(False)
             return
@@ -311,61 +833,382 @@ class PhotiniUploader(QtWidgets.QWidget):
             self.refresh(force=True)
             self.upload_button.setChecked(False)
             return
-        # start uploading in separate thread, so GUI can continue
-        self.upload_worker = UploadWorker(self.session_factory, self.get_upload_params())
-        self.upload_file.connect(self.upload_worker.upload_file)
-        self.upload_worker.upload_progress.connect(self.total_progress.setValue)
-        self.upload_worker.upload_file_done.connect(self.upload_file_done)
-        self.upload_worker.thread.start()
+        # record uploads in persistent queue
+        params = self.get_upload_params()
+        self.upload_batch, self.upload_ids = self.upload_queue.add(
+            self.save_upload_params(params),
+            [(image.path, (convert and convert.__name__,
+                           'metadata')[bool(photo_id)])
+             for ((image, convert), photo_id) in zip(
+                 self.upload_list, self.upload_photo_ids)])
+        self.run_upload(params)
+
+    def skip_uploaded(self, images):
+        # check ledger for images that have already been uploaded,
+        # return list of (image, photo_id) where photo_id is set if
+        # only the metadata is to be updated
+        with Busy():
+            photo_ids = {}
+            for image in images:
+                photo_id = self.ledger.get(self.ledger.file_hash(image.path))
+                if photo_id:
+                    photo_ids[image] = photo_id
+            self.ledger.commit()
+        uploaded = [x for x in images if x in photo_ids]
+        if not uploaded:
+            return [(x, None) for x in images]
+        dialog = QtWidgets.QMessageBox(parent=self)
+        dialog.setWindowTitle(self.tr('Photini: already uploaded'))
+        dialog.setText(self.tr('<h3>Some files have already been uploaded.</h3>'))
+        if hasattr(self.session, 'do_metadata_update'):
+            msg = self.tr(
+                '{0} of the {1} selected files have already been uploaded' +
+                ' to {2}. Would you like to update their metadata, or' +
+                ' upload them again?')
+        else:
+            msg = self.tr(
+                '{0} of the {1} selected files have already been uploaded' +
+                ' to {2}. Would you like to upload them again?')
+        dialog.setInformativeText(
+            msg.format(len(uploaded), len(images), self.service_name))
+        dialog.setDetailedText(
+            '\n'.join([os.path.basename(x.path) for x in uploaded]))
+        dialog.setIcon(QtWidgets.QMessageBox.Question)
+        dialog.setStandardButtons(QtWidgets.QMessageBox.Yes |
+                                  QtWidgets.QMessageBox.No |
+                                  QtWidgets.QMessageBox.Cancel)
+        dialog.setDefaultButton(QtWidgets.QMessageBox.No)
+        update_button = None
+        if hasattr(self.session, 'do_metadata_update'):
+            update_button = dialog.addButton(
+                self.tr('Update metadata'), QtWidgets.QMessageBox.AcceptRole)
+            dialog.setDefaultButton(update_button)
+        result = dialog.exec_()
+        if update_button and dialog.clickedButton() == update_button:
+            return [(x, photo_ids.get(x)) for x in images]
+        if result == QtWidgets.QMessageBox.Yes:
+            return [(x, None) for x in images]
+        if result == QtWidgets.QMessageBox.No:
+            return [(x, None) for x in images if x not in photo_ids]
+        return []
+
+    def save_upload_params(self, params):
+        # convert params to something that can be stored as JSON
+        return params
+
+    def load_upload_params(self, params):
+        # convert params saved by save_upload_params
+        return params
+
+    def resume_upload(self):
+        # restart uploads left unfinished when Photini was last closed
+        if self.upload_workers or not self.connected:
+            return
+        batch = self.upload_queue.next_batch()
+        if not batch:
+            return
+        if not self.authorise('write'):
+            # leave queue alone, to try again next time user connects
+            self.logger.warning('not permitted to resume uploads')
+            return
+        self.upload_batch, params, items = batch
+        with Busy():
+            params = self.load_upload_params(params)
+            paths = [x[1] for x in items if os.path.exists(x[1])]
+            if params is not None and paths:
+                self.image_list.open_file_list(paths)
+        images = dict([(x.path, x) for x in self.image_list.get_images()])
+        self.upload_list = []
+        self.upload_photo_ids = []
+        self.upload_ids = []
+        missing = []
+        for item, path, convert in items:
+            if params is None or path not in images:
+                missing.append(item)
+                continue
+            photo_id = None
+            if convert == 'metadata':
+                convert = None
+                photo_id = self.ledger.get(self.ledger.file_hash(path))
+                if not photo_id:
+                    missing.append(item)
+                    continue
+            elif convert:
+                convert = getattr(self, convert)
+            self.upload_list.append((images[path], convert))
+            self.upload_photo_ids.append(photo_id)
+            self.upload_ids.append(item)
+        if missing:
+            self.logger.warning('cannot resume %d uploads', len(missing))
+            self.upload_queue.done(missing)
+        if not self.upload_list:
+            # try next batch
+            self.resume_upload()
+            return
+        self.logger.info('resuming %d uploads', len(self.upload_list))
+        self.upload_button.setEnabled(True)
+        self.upload_button.setChecked(True)
+        self.run_upload(params)
+
+    def run_upload(self, params):
+        # start uploading in separate threads, so GUI can continue
+        self.upload_params = params
+        with Busy():
+            self.upload_hashes = [
+                self.ledger.file_hash(x[0].path) for x in self.upload_list]
+            self.ledger.commit()
+        for n in range(self.upload_worker_count()):
+            worker = UploadWorker(
+                self.session_factory, params, self.rate_limiter)
+            worker.upload_progress.connect(self.upload_progress)
+            worker.upload_file_done.connect(self.upload_file_done)
+            worker.thread.start()
+            self.upload_workers.append(worker)
+        # convert files in more threads, so conversion overlaps uploading
+        self.convert_ahead = max(1, int(self.config_store.get(
+            self.config_section, 'convert_ahead', '2')))
+        self.convert_space = int(self.config_store.get(
+            self.config_section, 'convert_space', '200')) * 1024 * 1024
+        for n in range(self.convert_worker_count()):
+            worker = ConvertWorker()
+            worker.convert_done.connect(self.convert_done)
+            worker.thread.start()
+            self.convert_workers.append(worker)
+        if self.convert_workers:
+            self.make_temp_dir()
+        # converted files, index -> path
+        self.converted = {}
+        # worker -> index of files being converted
+        self.converting = {}
+        self.idle_workers = []
         self.upload_config.setEnabled(False)
         self.user_connect.setEnabled(False)
+        # indexes into upload_list of files waiting to be uploaded
+        self.upload_pending = list(range(len(self.upload_list)))
+        # worker -> [index, percent done] of files being uploaded
+        self.upload_active = {}
+        # completed files, reported in upload_list order
+        self.upload_completed = set()
+        # failed files waiting for the user to choose abort or retry
+        self.upload_deciding = set()
+        # file sizes, for estimating time left
+        self.upload_sizes = [
+            (os.path.getsize(x[0].path), 0)[bool(y)]
+            for (x, y) in zip(self.upload_list, self.upload_photo_ids)]
         self.uploads_done = 0
-        self.next_upload()
+        self.convert_files()
+        for worker in self.upload_workers:
+            if not self.next_upload(worker):
+                self.idle_workers.append(worker)
 
-    def next_upload(self):
-        image, convert = self.upload_list[self.uploads_done]
-        self.total_progress.setFormat('{} ({}/{}) %p%'.format(
-            os.path.basename(image.path),
-            1 + self.uploads_done, len(self.upload_list)))
-        self.total_progress.setValue(0)
-        QtWidgets.QApplication.processEvents()
-        self.upload_file.emit(image, convert)
+    def convert_files(self):
+        # convert up to convert_ahead files that are waiting to upload,
+        # keeping within the temporary disk space budget
+        if not self.upload_button.isChecked():
+            return
+        idle = [x for x in self.convert_workers if x not in self.converting]
+        ahead = len(self.converting) + len(
+            [x for x in self.upload_pending if x in self.converted])
+        space = 0
+        for source in self.converted.values():
+            if isinstance(source, bytearray):
+                space += len(source)
+            elif os.path.exists(source):
+                space += os.path.getsize(source)
+        for idx in self.upload_pending:
+            if not idle or ahead >= self.convert_ahead:
+                return
+            if self.converted and space >= self.convert_space:
+                return
+            image, convert = self.upload_list[idx]
+            if (not convert or idx in self.converted or
+                    idx in self.converting.values()):
+                continue
+            worker = idle.pop(0)
+            self.converting[worker] = idx
+            worker.convert_next.emit(idx, image, convert)
+            ahead += 1
 
-    @QtCore.pyqtSlot(object, str)
-    def upload_file_done(self, image, error):
+    @QtCore.pyqtSlot(int, object, str)
+    def convert_done(self, idx, source, error):
+        worker = self.sender()
+        if self.converting.get(worker) != idx:
+            return
+        del self.converting[worker]
         if error:
-            dialog = QtWidgets.QMessageBox(self)
-            dialog.setWindowTitle(self.tr('Photini: upload error'))
-            dialog.setText(self.tr('<h3>File "{}" upload failed.</h3>').format(
-                os.path.basename(image.path)))
-            dialog.setInformativeText(error)
-            dialog.setIcon(QtWidgets.QMessageBox.Warning)
-            dialog.setStandardButtons(QtWidgets.QMessageBox.Abort |
-                                      QtWidgets.QMessageBox.Retry)
-            dialog.setDefaultButton(QtWidgets.QMessageBox.Retry)
-            if dialog.exec_() == QtWidgets.QMessageBox.Abort:
-                self.upload_button.setChecked(False)
+            self.upload_pending.remove(idx)
+            image, convert = self.upload_list[idx]
+            self.upload_deciding.add(idx)
+            if self.upload_error(image, error):
+                self.upload_pending.insert(0, idx)
+            self.upload_deciding.discard(idx)
+        else:
+            self.converted[idx] = source
+        self.convert_files()
+        while self.idle_workers and self.next_upload(self.idle_workers[0]):
+            self.idle_workers.pop(0)
+        self.check_finished()
+
+    def next_upload(self, worker):
+        if not self.upload_button.isChecked():
+            return False
+        # upload first file that doesn't need converting or has been
+        # converted
+        for idx in self.upload_pending:
+            image, convert = self.upload_list[idx]
+            if self.upload_photo_ids[idx]:
+                source = None
+                break
+            if not convert:
+                source = image.path
+                break
+            if idx in self.converted:
+                source = self.converted[idx]
+                break
         else:
-            self.uploads_done += 1
-        if (self.upload_button.isChecked() and
-                    self.uploads_done < len(self.upload_list)):
-            # start uploading next file (or retry same file)
-            self.next_upload()
+            return False
+        self.upload_pending.remove(idx)
+        self.upload_active[worker] = [idx, 0.0, 0.0]
+        self.show_progress()
+        if self.upload_photo_ids[idx]:
+            worker.update_next.emit(image, self.upload_photo_ids[idx])
+        else:
+            worker.upload_next.emit(image, source)
+        self.convert_files()
+        return True
+
+    def check_finished(self):
+        if self.upload_deciding:
+            # an error dialog is open, wait for the user's decision
             return
+        if self.upload_active or self.converting:
+            # wait for other workers to finish
+            self.show_progress()
+            return
+        if self.upload_button.isChecked() and self.upload_pending:
+            return
+        self.finish_upload()
+
+    @staticmethod
+    def format_rate(rate, remaining):
+        if not rate:
+            return ''
+        eta = timedelta(seconds=int(remaining / rate))
+        if rate >= 1024 * 1024:
+            return '{:.1f} MB/s, {} left'.format(rate / (1024 * 1024), eta)
+        return '{:.0f} kB/s, {} left'.format(rate / 1024, eta)
+
+    def show_progress(self):
+        count = len(self.upload_list)
+        if self.upload_active:
+            idx = min([x[0] for x in self.upload_active.values()])
+        else:
+            idx = min(self.uploads_done, count - 1)
+        image, convert = self.upload_list[idx]
+        # estimate time left from original file sizes
+        total_rate = 0.0
+        remaining = sum([self.upload_sizes[x] for x in self.upload_pending])
+        details = []
+        for idx, progress, rate in sorted(self.upload_active.values()):
+            size = self.upload_sizes[idx] * (100.0 - progress) / 100.0
+            remaining += size
+            total_rate += rate
+            details.append('{}: {:.0f}% {}'.format(
+                os.path.basename(self.upload_list[idx][0].path), progress,
+                self.format_rate(rate, size)))
+        rate = self.format_rate(total_rate, remaining)
+        if rate:
+            rate = ', ' + rate
+        self.total_progress.setFormat('{} ({}/{}) %p%{}'.format(
+            os.path.basename(image.path), 1 + self.uploads_done, count, rate))
+        self.total_progress.setToolTip('\n'.join(details))
+        done = (len(self.upload_completed) * 100.0) + sum(
+            [x[1] for x in self.upload_active.values()])
+        self.total_progress.setValue(int(done / count))
+
+    @QtCore.pyqtSlot(float, float)
+    def upload_progress(self, value, rate):
+        worker = self.sender()
+        if worker in self.upload_active:
+            self.upload_active[worker][1:] = value, rate
+            self.show_progress()
+
+    @QtCore.pyqtSlot(object, str, object)
+    def upload_file_done(self, image, error, photo_id):
+        worker = self.sender()
+        if worker not in self.upload_active:
+            return
+        idx = self.upload_active.pop(worker)[0]
+        if error:
+            self.upload_deciding.add(idx)
+            if self.upload_error(image, error):
+                # retry same file next, without converting it again
+                self.upload_pending.insert(0, idx)
+            self.upload_deciding.discard(idx)
+        else:
+            self.ledger.add(self.upload_hashes[idx], photo_id, image.path)
+            self.upload_queue.done([self.upload_ids[idx]],
+                                   self.save_upload_params(self.upload_params))
+            source = self.converted.pop(idx, None)
+            if source and not isinstance(source, bytearray):
+                os.unlink(source)
+            self.upload_completed.add(idx)
+            self.convert_files()
+            # report completions in order, even if files finish out of order
+            while self.uploads_done in self.upload_completed:
+                done_image, convert = self.upload_list[self.uploads_done]
+                self.logger.info('uploaded %s', done_image.path)
+                self.uploads_done += 1
+        if not self.next_upload(worker):
+            self.idle_workers.append(worker)
+        self.check_finished()
+
+    def upload_error(self, image, error):
+        dialog = QtWidgets.QMessageBox(self)
+        dialog.setWindowTitle(self.tr('Photini: upload error'))
+        dialog.setText(self.tr('<h3>File "{}" upload failed.</h3>').format(
+            os.path.basename(image.path)))
+        dialog.setInformativeText(error)
+        dialog.setIcon(QtWidgets.QMessageBox.Warning)
+        dialog.setStandardButtons(QtWidgets.QMessageBox.Abort |
+                                  QtWidgets.QMessageBox.Retry)
+        dialog.setDefaultButton(QtWidgets.QMessageBox.Retry)
+        if dialog.exec_() == QtWidgets.QMessageBox.Abort:
+            self.upload_button.setChecked(False)
+            return False
+        return True
+
+    def finish_upload(self):
+        # forget any uploads the user stopped or aborted
+        completed = len(self.upload_completed) == len(self.upload_list)
+        self.upload_queue.done(
+            [x for (n, x) in enumerate(self.upload_ids)
+             if n not in self.upload_completed])
         self.upload_button.setChecked(False)
         self.total_progress.setValue(0)
         self.total_progress.setFormat('%p%')
+        self.total_progress.setToolTip('')
         self.upload_config.setEnabled(True)
         self.user_connect.setEnabled(True)
         self.upload_finished()
-        self.upload_file.disconnect()
-        self.upload_worker.upload_progress.disconnect()
-        self.upload_worker.upload_file_done.disconnect()
-        self.upload_worker.thread.quit()
-        self.upload_worker.thread.wait()
-        self.upload_worker = None
+        for worker in self.upload_workers:
+            worker.upload_progress.disconnect()
+            worker.upload_file_done.disconnect()
+            worker.thread.quit()
+            worker.thread.wait()
+        self.upload_workers = []
+        for worker in self.convert_workers:
+            worker.convert_done.disconnect()
+            worker.thread.quit()
+            worker.thread.wait()
+        self.convert_workers = []
+        self.converting = {}
+        self.converted = {}
+        self.remove_temp_dir()
         # enable or disable upload button
         self.new_selection(self.image_list.get_selected_images())
+        if completed and self.upload_queue.pending:
+            QtCore.QTimer.singleShot(0, self.resume_upload)
 
     def auth_dialog(self, auth_url):
         if webbrowser.open(auth_url, new=2, autoraise=0):